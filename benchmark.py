@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+r'''usage: benchmark.py [args] [benchmark ...]
+
+Time the hot paths of latex.py on generated documents. Each benchmark grows
+the document along one axis (macros per line, nesting depth of arguments,
+number of \newcommands, number of \input files, number of macro prefixes,
+size of %@ blocks), and times one function: parse(), consume_args(),
+unescape() or latex_input(). The results are written as JSON, so that two
+revisions can be compared:
+
+    cp benchmark.py /tmp
+    git checkout old; python /tmp/benchmark.py -o old.json
+    git checkout new; python /tmp/benchmark.py -c old.json
+
+latex.py is imported from the current directory, if it is there, so that a
+copy of this file can time revisions that do not have it.
+
+Without arguments, all benchmarks are run.
+
+=== Optional arguments ===
+
+    -o <file>
+    --output <file>      Write the results to <file> [benchmark.json].
+    -c <file>
+    --compare <file>     Compare the results with those in <file>, written
+                         by an earlier run.
+    -n <n>
+    --repeat <n>         Report the best of <n> runs [3].
+    -s <factor>
+    --scale <factor>     Multiply the document sizes by <factor> [1].
+    -l
+    --list               List the benchmarks.
+    -h
+    --help               Print this text
+'''
+
+from __future__ import print_function, absolute_import, division
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+import timeit
+import copy
+
+sys.path.insert(0, os.getcwd())
+import latex
+
+class args(object):
+    outf_name = 'benchmark.json'
+    compare   = None
+    repeat    = 3
+    scale     = 1.0
+    names     = []
+
+########## Document generators ##########
+
+# Each generator writes its files in the current directory, and returns the
+# function to time. The sizes are the points along the axis of the benchmark.
+
+def n_lines(n):
+    return max(1, int(n*args.scale))
+
+def write(fname, lines):
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    return fname
+
+def parse_file(fname):
+    def run():
+        for l in latex.parse(fname):
+            pass
+    return run
+
+def gen_macros_per_line(k):
+    header = [r'\newcommand{\A}{\mathrm{A}}',
+              r'\newcommand{\B}[1]{\hat{#1}}',
+              r'\newcommand{\C}[2][x]{#1+#2}']
+    uses = [r'\A', r'\B{y}', r'\C{z}', r'\C[w]{v}']
+    text = ['Line %d: %s.' % (i, ' and '.join(uses[j%len(uses)] for j in range(k)))
+            for i in range(n_lines(2000))]
+    return parse_file(write('doc.tex', header+text))
+
+def gen_nesting_depth(d):
+    header = [r'\newcommand{\f}[1]{(#1)}']
+    arg = 'x'
+    for i in range(d):
+        arg = r'\f{%s}' % arg
+    text = ['Line %d: $%s$.' % (i, arg) for i in range(n_lines(1000))]
+    return parse_file(write('doc.tex', header+text))
+
+def gen_newcommands(n):
+    header = [r'\newcommand{\m%s}[1]{m_{%d}(#1)}' % (name(i), i) for i in range(n)]
+    text = ['Line %d: \\m%s{a} and \\m%s{b}.' % (i, name(i%n), name((7*i)%n))
+            for i in range(n_lines(2000))]
+    return parse_file(write('doc.tex', header+text))
+
+def name(i):
+    # macro names can not contain digits in latex
+    s = ''
+    while True:
+        s += chr(ord('a')+i%26)
+        i //= 26
+        if not i:
+            return s
+
+def gen_inputs(n):
+    per_file = max(1, n_lines(2000)//n)
+    for i in range(n):
+        write('ch%d.tex' % i, [r'Chapter %d, line %d: \A.' % (i, j) for j in range(per_file)])
+    main = [r'\newcommand{\A}{\mathrm{A}}'] + [r'\input{ch%d}' % i for i in range(n)]
+    return parse_file(write('doc.tex', main))
+
+def gen_scopes(n):
+    prefixes = '@!?&+=;~'[:n]
+    # The first macro makes '\\' the main scope, see get_scope()
+    header = [r'\documentclass{article}', '{%@'] \
+             + ["with scope('%s'):\n    m = r'\\mathrm{m_%d}'" % (p, i) for i, p in enumerate(prefixes)] \
+             + ['}%@']
+    text = ['Line %d: %s.' % (i, ' '.join(p+'m' for p in prefixes)) for i in range(n_lines(2000))]
+    return parse_file(write('doc.tex', header+text))
+
+def gen_block_size(n):
+    lines = []
+    for b in range(20):
+        lines += ['%%@x_%d_%d = %d' % (b, i, i) for i in range(n_lines(n))]
+        lines += ['Text after block %d.' % b]
+    return parse_file(write('doc.tex', lines))
+
+def gen_consume_args(d):
+    arg = 'x'
+    for i in range(d):
+        arg = '{a%s b}' % arg
+    lines = ['[opt]%s{y}%s rest of line %d' % (arg, arg, i) for i in range(n_lines(10000))]
+    def run():
+        for l in lines:
+            latex.consume_args(l)
+    return run
+
+def gen_unescape(k):
+    esc = latex.escape(r'\A \{ \\')
+    lines = ['Line %d: %s' % (i, ' '.join([esc]*k)) for i in range(n_lines(10000))]
+    def run():
+        for l in lines:
+            latex.unescape(l)
+    return run
+
+def gen_latex_input(n):
+    for i in range(n):
+        write('ch%d.tex' % i, [r'Chapter %d, line %d: \A.' % (i, j) for j in range(50)])
+    latex.get_macro().A = r'\mathrm{A}'
+    def run():
+        for i in range(n):
+            for l in latex.latex_input('ch%d' % i):
+                pass
+    return run
+
+# name: (function timed, generator, sizes)
+benchmarks = [
+    ('macros_per_line', 'parse',        gen_macros_per_line, [1, 4, 16]),
+    ('nesting_depth',   'parse',        gen_nesting_depth,   [1, 4, 16]),
+    ('newcommands',     'parse',        gen_newcommands,     [10, 100, 1000]),
+    ('inputs',          'parse',        gen_inputs,          [1, 10, 100]),
+    ('scopes',          'parse',        gen_scopes,          [1, 2, 4, 8]),
+    ('block_size',      'parse',        gen_block_size,      [10, 100, 1000]),
+    ('arg_depth',       'consume_args', gen_consume_args,    [1, 4, 16]),
+    ('escapes',         'unescape',     gen_unescape,        [1, 4, 16]),
+    ('input_files',     'latex_input',  gen_latex_input,     [10, 100]),
+]
+
+########## Running ##########
+
+class plain_reset(object):
+    """For revisions of latex.py without state_snapshot: a copy of the main
+    scope and its macros, and of the other globals that expansion changes."""
+    names = ['usage_count', 'pending_output', 'warned', '_latex']
+
+    def __init__(self):
+        self.scope = dict(latex.main_parser_scope)
+        self.macros = dict(vars(latex.main_parser_scope['__macros__']))
+        self.values = dict((name, copy.deepcopy(getattr(latex, name))) for name in self.names)
+        self.parser_scopes = dict(latex.parser_scopes)
+
+    def restore(self):
+        scope = latex.main_parser_scope
+        scope.clear()
+        scope.update(self.scope)
+        vars(scope['__macros__']).clear()
+        vars(scope['__macros__']).update(self.macros)
+        latex.parser_scopes.clear()
+        latex.parser_scopes.update(self.parser_scopes)
+        for name, value in self.values.items():
+            setattr(latex, name, copy.deepcopy(value))
+
+def run_benchmark(snapshot, name, function, generator, size):
+    """Return the best time of args.repeat runs. The parser state is reset
+    before each run, and the files are generated in a temporary directory."""
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix='latex-bench-')
+    try:
+        os.chdir(tmpdir)
+        snapshot.restore()
+        run = generator(size)
+        setup = snapshot.__class__()
+        best = None
+        for i in range(args.repeat):
+            setup.restore()
+            t0 = timeit.default_timer()
+            run()
+            t = timeit.default_timer() - t0
+            best = t if best is None else min(best, t)
+        return best
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(latex.__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, old):
+    if old.get('scale') != results['scale'] or old.get('repeat') != results['repeat']:
+        print('Warning: %s was run with other settings (scale %s, repeat %s)'
+              % (args.compare, old.get('scale'), old.get('repeat')), file=sys.stderr)
+    old_times = dict(((r['benchmark'], r['size']), r['seconds']) for r in old['results'])
+    print('%-16s %-13s %6s %10s %10s %7s' % ('benchmark', 'function', 'size', 'old', 'new', 'ratio'))
+    for r in results['results']:
+        t = old_times.get((r['benchmark'], r['size']))
+        if t is None:
+            continue
+        print('%-16s %-13s %6d %10.4f %10.4f %7.2f' % (r['benchmark'], r['function'], r['size'],
+                                                     t, r['seconds'], r['seconds']/t))
+
+def parse_args():
+    idx = 1
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        if arg in ['-o', '--output']:
+            idx += 1
+            args.outf_name = sys.argv[idx]
+        elif arg in ['-c', '--compare']:
+            idx += 1
+            args.compare = sys.argv[idx]
+        elif arg in ['-n', '--repeat']:
+            idx += 1
+            args.repeat = int(sys.argv[idx])
+        elif arg in ['-s', '--scale']:
+            idx += 1
+            args.scale = float(sys.argv[idx])
+        elif arg in ['-l', '--list']:
+            for name, function, generator, sizes in benchmarks:
+                print('%-16s %-13s %s' % (name, function, sizes))
+            sys.exit(0)
+        elif arg in ['-h', '--help']:
+            print(__doc__)
+            sys.exit(0)
+        else:
+            break
+        idx += 1
+    args.names = sys.argv[idx:]
+    unknown = set(args.names) - set(b[0] for b in benchmarks)
+    if unknown:
+        print('Unknown benchmark: %s' % ', '.join(sorted(unknown)), file=sys.stderr)
+        sys.exit(1)
+
+def main():
+    parse_args()
+    latex.set_latex_parse_mode()
+    latex.args.verbose = 0
+    if hasattr(latex, 'state_snapshot'):
+        snapshot = latex.state_snapshot()
+    else:
+        snapshot = plain_reset()
+
+    results = {'revision': revision(), 'python': sys.version.split()[0],
+               'repeat': args.repeat, 'scale': args.scale, 'results': []}
+    for name, function, generator, sizes in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        for size in sizes:
+            t = run_benchmark(snapshot, name, function, generator, size)
+            print('%-16s %-13s %6d %10.4f' % (name, function, size, t))
+            results['results'].append({'benchmark': name, 'function': function,
+                                       'size': size, 'seconds': t})
+
+    with open(args.outf_name, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
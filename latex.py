@@ -24,6 +24,8 @@ Latex preprocessor. There are three main use cases:
        deps=$(python parse.py -i macros.py manuscript.tex | python parse.py \
               -P includegraphics:1:%s.pdf \
               -P bibliography:1:%s.bib)
+   Or write the dependencies as a makefile rule while expanding, with
+       python parse.py -L --deps manuscript.d -o manuscript.texp manuscript.tex
 
 Note that python3 syntax is used.
 
@@ -33,6 +35,9 @@ Note that python3 syntax is used.
     --output <file>      Output filename [stdout]. If extension is .ps, .dvi
                          or .pdf, build this file using *latex (preprocessed
                          file will then be called <basename>.texp).
+    --timeout <seconds>  With -o <file>.pdf etc, stop the build if a run of
+                         *latex or bibtex takes longer than this [300]. With
+                         -j, also the longest wait for a worker.
     -v <level>
     --verbose <level>    0: print nothing, 1: print errors except KeyError,
                          [2]: print all errors, 3: print a lot.
@@ -59,6 +64,16 @@ Note that python3 syntax is used.
 
     -q
     --quiet              Don't output anything. Same effect as '-o /dev/null'.
+    --encoding <enc>     Read and write files with the encoding <enc>, instead
+                         of the default of the platform. Give it before -i
+                         and -o.
+    --deps <file>        Also write a makefile rule to <file>, which makes the
+                         output file (or <file> with extension .texp, if
+                         there is no -o) depend on the files that were read:
+                         the input files, -i files and \input files, and the
+                         files named by \includegraphics and \bibliography.
+                         An empty rule is added for each of these files but
+                         the input files, like 'gcc -MD -MP' does.
 
     -L
     --parse-latex-commands
@@ -73,6 +88,8 @@ Note that python3 syntax is used.
                          Can also use <cmd>:<n> which prints only the n'th
                          argument, or <cmd>:<n>:<format_str> which applies
                          <format_str> to print the argument. See (3) above.
+                         Macros that can not lead to a printed command
+                         are not expanded.
     -I <cmd>
     --ignore <cmd>       Ignore this macro (leave it unexpanded).
                          Useful also to silence unwanted warnings, for example
@@ -83,6 +100,51 @@ Note that python3 syntax is used.
     -2
     --two-pass           Two passes over the input file, allowing the first
                          pass to collect information for the whole file.
+    --cache <dir>        Store the expansion of each \input file in <dir>, and
+                         reuse it in later runs if neither the file nor the
+                         macros it uses have changed. Files that run python
+                         code are not stored.
+    --cache-size <MB>    Size limit for the --cache directory [100]. The least
+                         recently used entries are removed first.
+    --incremental        Reuse the expansion of the paragraphs of each input
+                         file that are unchanged since the last run, and whose
+                         macros are unchanged. Implies '--cache .latex.py-cache'
+                         unless --cache is given. Not used with -2 or -N.
+    -j <n>
+    --jobs <n>           Expand the \input files of the main file in <n>
+                         processes [1]. A file is expanded again in the main
+                         process if the macros it uses were changed by the
+                         files before it, or if it runs python code.
+                         Bibtex is also run on up to <n> (or the number of
+                         CPUs, if higher) bibunits at once.
+    --profile            After execution, list the time taken by each macro and
+                         %@ block, with the number of calls, how many results
+                         contained macros (and so were scanned again), and
+                         how many characters were added to the text.
+    --profile-json <file>
+                         Same as --profile, but write the numbers to <file>
+                         as JSON.
+    --batch <file>       Run each line of <file> as a separate latex.py
+                         command line (options and input files), in this
+                         process. The options before --batch, and the input
+                         files given with it, are processed once; each job
+                         starts from the resulting macros. Lines starting
+                         with '#' are ignored. Example:
+                             latex.py -L -i macros.py --batch jobs header.tex
+    --server <socket>    Like --batch, but take the jobs from clients that
+                         connect to the unix socket <socket>. The server
+                         restarts itself when a file given with -i or as an
+                         input file has changed. Note that -o <file>.pdf runs
+                         latex in the server.
+    --client <socket>    Must be the first option. Send the rest of the command
+                         line to the server at <socket>, and output the
+                         result as if it was run here. If no server is
+                         running, it fails (the server's options are not
+                         known here).
+    -E
+    --eval-calls         Expand each macro by formatting and eval'ing a python
+                         call string (the pre-2.01 behaviour), instead of
+                         calling the macro directly with the arguments. Slower.
     -V
     --version            Print the version number. The major (integer) part
                          is bumped when incompatible changes are made.
@@ -91,7 +153,8 @@ Note that python3 syntax is used.
 
 === Known bugs / limitations ===
 
-Text passed to macros may not contain three double quotes (""") in a row.
+With -E, text passed to macros may not contain three double quotes (""")
+in a row.
 
 === License, author ===
 
@@ -110,10 +173,27 @@ import re
 import itertools
 import collections
 import contextlib
+import binascii
+import json
+import io
+import threading
+from timeit import default_timer as timer
+# The builtins of the macros and the %@ code: python's builtins, and the
+# functions marked with @builtin. With python3 they are kept in a copy, so that
+# python's own builtins module is not changed. (With python2, code run with other
+# builtins than the interpreter's is in restricted mode.)
 try:
     import __builtin__
 except ImportError:
-    import builtins as __builtin__ # python3
+    import builtins, types # python3
+    __builtin__ = types.ModuleType('builtins')
+    vars(__builtin__).update(vars(builtins))
+# A file in memory that holds native strings (with python2, io.StringIO only
+# takes unicode)
+if str is bytes:
+    native_io = io.BytesIO
+else:
+    native_io = io.StringIO
 
 ########## Scopes ###############################
 
@@ -122,7 +202,7 @@ except ImportError:
 # examples/simple/multi_prefix.tex for example of use.
 class __macros:
     pass
-main_parser_scope = {'__builtin__': __builtin__, '__macros__': __macros()}
+main_parser_scope = {'__builtin__': __builtin__, '__builtins__': __builtin__, '__macros__': __macros()}
 parser_scopes = {} # populated in get_scope()
 
 def builtin(f):
@@ -150,9 +230,9 @@ def get_scope(x=None):
             args.macro_prefix.append(x)
     else:
         new_scope = parser_scopes[x]
-    if new_scope != main_parser_scope:
+    if new_scope is not main_parser_scope:
         # ensure the hidden attributes are the same everywhere
-        copy_hidden(main_parser_scope, new_scope)
+        sync_hidden(main_parser_scope, new_scope)
     return new_scope
 
 @builtin
@@ -179,7 +259,7 @@ def call(x, *args, **kwargs):
 def scope(x):
     orig_scope = get_scope()
     new_scope = get_scope(x)
-    if orig_scope == new_scope:
+    if orig_scope is new_scope:
         yield orig_scope
     else:
         scope_copy = orig_scope.copy()
@@ -199,8 +279,12 @@ def scope(x):
 @contextlib.contextmanager
 def eval_scope(x):
     global main_parser_scope
-    orig_scope = get_scope()
-    new_scope = get_scope(x)
+    orig_scope = main_parser_scope
+    new_scope = parser_scopes.get(x)
+    if new_scope is None:
+        new_scope = get_scope(x)
+    elif new_scope is not orig_scope:
+        sync_hidden(orig_scope, new_scope, lazy=True)
     try:
         main_parser_scope = new_scope
         yield new_scope
@@ -210,8 +294,8 @@ def eval_scope(x):
 @builtin
 def current_match(idx=1):
     if (idx == 0):
-        out, cur = _current_match[0]
-        return bracket_unescape(''.join(out[-1:]) + unescape(cur))
+        out, done, cur = _current_match[0]
+        return bracket_unescape(''.join(out[-1:]) + unescape(''.join(done) + cur))
     return bracket_unescape(_current_match[idx])
 
 def remove_macros_from(s):
@@ -227,6 +311,37 @@ def copy_hidden(fro, to):
         if '_' in k and k not in ['__macros__', '__missing__']:
             to[k] = fro[k]
 
+# The hidden attributes are copied from the running scope whenever another scope
+# is used, which eval_scope does for every macro with another prefix. To make
+# that cheap, eval_scope skips the copy if nothing can have changed since the
+# last copy between the same two scopes: _hidden_version is bumped (by
+# hidden_changed) after python code has run, since it may assign anything, and
+# _hidden_copies counts the copies into each scope.
+_hidden_version = 0
+_hidden_copies = collections.defaultdict(int)   # id(scope) -> number of copies into it
+_hidden_synced = {}                             # id(scope) -> state at the last copy into it
+
+def sync_hidden(fro, to, lazy=False):
+    state = (_hidden_version, id(fro), _hidden_copies[id(fro)])
+    if lazy and _hidden_synced.get(id(to)) == state:
+        return
+    copy_hidden(fro, to)
+    _hidden_copies[id(to)] += 1
+    _hidden_synced[id(to)] = state
+
+def hidden_changed():
+    global _hidden_version
+    _hidden_version += 1
+    definitions_changed()      # the python code may also have defined macros
+
+# False for the macros that are known not to run python code of the user.
+def runs_python(obj):
+    if isinstance(obj, (str, latex_new_comm)) or obj in cache_safe_macros():
+        return False
+    if hasattr(obj, 'chained_cmd'):     # see latex_print
+        return obj.chained_cmd is not None and runs_python(obj.chained_cmd)
+    return True
+
 ########## Arguments #####################
 
 @builtin
@@ -242,13 +357,28 @@ class args(object):
     show_blocks  = False
     show_lines   = False
     two_pass     = False
+    eval_calls   = False
+    cache_dir    = None
+    cache_size   = 100           # MB
+    incremental  = False
+    jobs         = 1
+    batch        = None
+    server       = None
+    profile      = False
+    profile_json = None
+    build_timeout = 300         # seconds
+    print_cmds   = []
+    encoding     = None
+    outf_name    = None
+    deps_file    = None
+    dependencies = []           # files read or referenced, for --deps
     block_prefix = '%@'
     macro_prefix = ['@']
     format_pattern = r'(?:#\({0}\)|<{0}>)'
     escape       = ('{_}', '{__}', '{___}', '{____}')
     dummy        = '{^}'
     pattern      = r'a-zA-Z0-9*'
-    version      = 2.00
+    version      = 2.01
 
     bracket_words  = [r'\\', # Simplifies parsing to get rid of this first
                       r'\left[', r'\right]', 
@@ -262,6 +392,20 @@ class args(object):
 usage_count = collections.defaultdict(int)
 get_scope()['usage_count'] = usage_count
 
+# With --profile: for each macro (keyed by prefix and name) and %@ block (keyed
+# by file and line), the number of calls, the total time, the number of results
+# that are scanned again for macros, and the growth of the text in characters.
+profile = collections.defaultdict(lambda: [0, 0.0, 0, 0])
+
+def profile_record(key, t0, old_len, result):
+    t = timer() - t0
+    entry = profile[key]
+    entry[0] += 1
+    entry[1] += t
+    if any(prefix in result for prefix in args.macro_prefix):
+        entry[2] += 1
+    entry[3] += len(result) - old_len
+
 ##### Support functions for the ':' string syntax (see fixup_line) ######
 
 pending_output = []
@@ -273,12 +417,34 @@ def pop_pending_output():
     pending_output = []
     return ret
 
+# Prepared format strings, keyed by (string, kwargs_only, format_pattern). String
+# macros are prepared on every call, so this saves the regexp work for macros
+# that are used repeatedly. The cache is simply emptied when it is full.
+_format_cache = {}
+_format_cache_stats = {'hits': 0, 'misses': 0}
+format_cache_size = 4096
+
 @builtin
 def prepare_format(s, kwargs_only=False):
+    key = (s, kwargs_only, args.format_pattern)
+    try:
+        ret = _format_cache[key]
+        _format_cache_stats['hits'] += 1
+        return ret
+    except KeyError:
+        _format_cache_stats['misses'] += 1
     pattern = args.format_pattern.format(r'([a-zA-Z0-9_]*[a-zA-Z_][a-zA-Z0-9_]*)' if kwargs_only else r'([a-zA-Z0-9_]+)')
-    s = s.replace('{', '{{').replace('}', '}}')
-    s = re.sub(pattern, lambda m: '{%s}'%(m.group(1) or m.group(2) or ''), s)
-    return s
+    ret = s.replace('{', '{{').replace('}', '}}')
+    ret = re.sub(pattern, lambda m: '{%s}'%(m.group(1) or m.group(2) or ''), ret)
+    if len(_format_cache) >= format_cache_size:
+        _format_cache.clear()
+    _format_cache[key] = ret
+    return ret
+
+@builtin
+def format_cache_info():
+    """Return (hits, misses, size) for the prepare_format() cache."""
+    return (_format_cache_stats['hits'], _format_cache_stats['misses'], len(_format_cache))
 
 @builtin
 def output(s):
@@ -286,42 +452,77 @@ def output(s):
 
 #### Parsing arguments. Not easily done with regexps because of possible nesting. #####
 
-# Return one argument, formatted as a python string.
-def consume_arg(l, brak):
-    level = 0
-    pos = 0
-    for c in l:
-        if   c == brak[0]: level += 1
-        elif c == brak[1]: level -= 1
-        pos += 1
+# The arguments are scanned by position in the line, and only the brackets are
+# looked at (found by a regexp), so that long arguments are not copied or
+# stepped through character by character.
+_re_brackets = {'{}': re.compile(r'[{}]'), '[]': re.compile(r'[][]')}
+
+class unclosed_argument(TypeError):
+    """Raised by consume_args. The state is where the scan stopped, so that it
+    can be resumed when the next line is appended."""
+    def __init__(self, state):
+        TypeError.__init__(self, 'Argument not closed')
+        self.state = state
+
+# Scan the argument that starts with brak[0] at pos (or, if level > 0, continue
+# scanning it from pos). Return the position after the closing bracket, or None
+# and the bracket level at the end of the line.
+def consume_arg(l, pos, brak, level=0):
+    for m in _re_brackets[brak].finditer(l, pos):
+        if m.group() == brak[0]: level += 1
+        else:                    level -= 1
         if level == 0:
-            (arg, rest_of_line) = l[1:pos-1], l[pos:]
-            assert not '"""' in arg
-            return ('r"""%s^"""[:-1]'%arg, rest_of_line)
-    raise TypeError('Argument not closed')
-
-# Return as many arguments as possible. Ignore spaces between arguments,
-# and allow exactly one optional argument [] if it comes first. The optional
-# argument is moved to the last position, to allow the standard "def a(x,y='')".
-# The awkward implementation is to avoid eating spaces unless they are followed
-# by an argument (but maybe we should never eat spaces?)
-def consume_args(l):
-    args = []
-    optarg = None
-    pos = 0
-    while len(l) > pos and l[pos] == ' ':
-        pos += 1
-    if len(l) > pos and l[pos] == '[':
-        (optarg,l) = consume_arg(l[pos:], '[]')
+            return m.end(), 0
+    return None, level
+
+# Return as many arguments as possible from l[pos:], and the position after
+# them. Ignore spaces between arguments, and allow exactly one optional argument
+# [] if it comes first. The optional argument is moved to the last position, to
+# allow the standard "def a(x,y='')". Spaces are not eaten unless they are
+# followed by an argument (but maybe we should never eat spaces?). If an
+# argument is not closed, unclosed_argument is raised; its state can be passed
+# back when the line has been extended, and the scan continues where it stopped.
+def consume_args(l, pos=0, state=None):
+    base = pos
+    if state:
+        args, optarg, start, level, brak, scan = state
+        args = list(args)
+        start += base
+        scan += base
+    else:
+        args, optarg, brak = [], None, None
     while True:
-        pos = 0
-        while len(l) > pos and l[pos] == ' ':
-            pos += 1
-        if len(l) <= pos or l[pos] != '{':
-            if optarg: args.append(optarg)
-            return args, l
-        (arg,l) = consume_arg(l[pos:], '{}')
-        args.append(arg)
+        if brak is None:
+            arg_pos = pos
+            while len(l) > arg_pos and l[arg_pos] == ' ':
+                arg_pos += 1
+            if len(l) > arg_pos and l[arg_pos] == '[' and pos == base:
+                brak = '[]'
+            elif len(l) > arg_pos and l[arg_pos] == '{':
+                brak = '{}'
+            else:
+                if optarg is not None: args.append(optarg)
+                return args, pos
+            start = scan = arg_pos
+            level = 0
+        end, level = consume_arg(l, scan, brak, level)
+        if end is None:
+            raise unclosed_argument((args, optarg, start-base, level, brak, len(l)-base))
+        if brak == '[]':
+            optarg = l[start+1:end-1]
+        else:
+            args.append(l[start+1:end-1])
+        pos = end
+        brak = None
+
+# Format an argument as a python string literal. Only used for the eval path
+# (args.eval_calls) and for messages.
+def quote_arg(arg):
+    return 'r"""%s^"""[:-1]'%arg
+
+def call_str(comm, comm_args):
+    return '__builtin__.call(__builtin__.get_macro(r"%s"),%s)' \
+        % (comm, ','.join(map(quote_arg, comm_args)))
 
 ####### Support functions for exec'ing code blocks #############
 
@@ -352,12 +553,21 @@ def fixup_line(l):
     return l
 
 warned = set(['input'])
-def exec_block(lines):
+def exec_block(lines, where=None):
     if args.verbose >= 3:
         debuglines = '>>> '+lines.replace('\n', '\n>>> ')+'\n'
         args.errf.write(debuglines);
+    if _recorders:
+        record_uncacheable()
     try:
+        if args.profile:
+            t0 = timer()
+            pending = sum(map(len, pending_output))
         exec(lines, get_scope())
+        hidden_changed()
+        if args.profile:
+            new_output = ''.join(pending_output)
+            profile_record('%@ '+(where or '?'), t0, pending, new_output)
         if args.verbose >= 1:
             for k in get_scope().keys():
                 if hasattr(__builtin__, k) and not k in warned:
@@ -372,82 +582,434 @@ def exec_block(lines):
 
 ######### Misc. support functions #################
 
+# Compiled regexps and substitution tables for the lexical details given by args
+# (prefixes, escapes, bracket words, the dummy). They are built once, and rebuilt
+# by get_lexer() only when one of the settings changes, for example when
+# get_scope() registers a new prefix.
+class lexer_tables(object):
+    def __init__(self, key):
+        self.key = key
+        (macro_prefix, pattern, bracket_words, bracket_escape, escapes, dummy) = key
+
+        # A macro is a prefix, followed by the name and one character which is
+        # not part of the name.
+        self.re_macro = re.compile(r'[%s]([%s]*)[^%s]'
+                                   % (re.escape(''.join(macro_prefix)), pattern, pattern))
+
+        self.escape_table = {}
+        self.unescape_table = {}
+        for a,b in zip(macro_prefix, escapes):
+            self.escape_table.setdefault(a, b)
+            self.unescape_table.setdefault(b, a)
+        self.re_escape = alternation(self.escape_table)
+        self.re_unescape = alternation(self.unescape_table)
+
+        # Bracket words are replaced in order, so that '\\' is found first.
+        self.bracket_table = {}
+        self.bracket_untable = {}
+        for i,kw in enumerate(bracket_words):
+            self.bracket_table.setdefault(kw, bracket_escape%i)
+            self.bracket_untable.setdefault(bracket_escape%i, kw)
+        self.re_bracket_escape = alternation(self.bracket_table, bracket_words)
+        self.re_bracket_unescape = alternation(self.bracket_untable)
+
+        self.dummy = dummy
+        dummy = re.escape(dummy)
+        self.re_dummy = [
+            (re.compile(r'^(\s*('+dummy+r'\s*)+\n)+'),  r''),   # lines at the start
+            (re.compile(r'\n(\s*('+dummy+r'\s*)+\n)+'), r'\n'), # ... in the middle
+            (re.compile(r'(\n\s*('+dummy+r'\s*)+)+$'),  r'\n'), # ... at the end
+            ]
+
+# Compile a regexp matching any of the given words (longest first, unless an
+# order is given), for single-pass replacement using sub_table().
+def alternation(table, order=None):
+    if order is None:
+        order = sorted(table, key=len, reverse=True)
+    if not order:
+        return None
+    return re.compile('|'.join(map(re.escape, order)))
+
+def sub_table(regexp, table, line):
+    if regexp is None:
+        return line
+    return regexp.sub(lambda m: table[m.group()], line)
+
+_lexer = None
+def get_lexer():
+    global _lexer
+    key = (tuple(args.macro_prefix), args.pattern, tuple(args.bracket_words),
+           args.bracket_escape, tuple(args.escape), args.dummy)
+    if _lexer is None or _lexer.key != key:
+        _lexer = lexer_tables(key)
+    return _lexer
+
 @builtin
 def escape(line):
-    global args
-    for a,b in zip(args.macro_prefix, args.escape):
-        line = line.replace(a,b)
-    return line
+    lexer = get_lexer()
+    return sub_table(lexer.re_escape, lexer.escape_table, line)
 def unescape(line):
-    global args
-    for a,b in zip(args.escape, args.macro_prefix):
-        line = line.replace(a,b)
+    lexer = get_lexer()
+    line = sub_table(lexer.re_unescape, lexer.unescape_table, line)
     # Remove space taken by macros that return nothing. It is complicated because we
     # do not want macros that expand to nothing to introduce new totally blank lines,
     # but blank lines in the original text should be preserved. Note also that line may
     # at this point contain multiple linebreaks.
-    if args.dummy in line:
+    if lexer.dummy in line:
         l0 = line
-        dummy = re.escape(args.dummy)
-        line = re.sub(r'^(\s*('+dummy+r'\s*)+\n)+',  r'', line)   # lines at the start
-        line = re.sub(r'\n(\s*('+dummy+r'\s*)+\n)+', r'\n', line) # ... in the middle
-        line = re.sub(r'(\n\s*('+dummy+r'\s*)+)+$',  r'\n', line) # ... at the end
-        line = line.replace(args.dummy, '') # and finally handle lines with other non-whitespace
+        for dummy_re, replace_with in lexer.re_dummy:
+            line = dummy_re.sub(replace_with, line)
+        line = line.replace(lexer.dummy, '') # and finally handle lines with other non-whitespace
         if args.verbose >= 3:
             log('"%s"'%l0.replace('\n',r'\n'), '==>', '"%s"'%line.replace('\n', r'\n'))
     return line
 
 def bracket_escape(line):
-    for i,kw in enumerate(args.bracket_words):
-        line = line.replace(kw, args.bracket_escape%i)
-    return line
+    lexer = get_lexer()
+    return sub_table(lexer.re_bracket_escape, lexer.bracket_table, line)
 def bracket_unescape(line):
-    for i,kw in enumerate(args.bracket_words):
-        line = line.replace(args.bracket_escape%i, kw)
-    return line
+    lexer = get_lexer()
+    return sub_table(lexer.re_bracket_unescape, lexer.bracket_untable, line)
 
+# The file name and line number being parsed. The message prefix is only
+# formatted when a message is written.
+_position = ('', 0)
 _prev_prefix = None
+
+def line_prefix():
+    return '%s %d:' % _position
+
 @builtin
 def log(*text):
-    global prefix1, prefix2, _prev_prefix
-    if prefix1 != _prev_prefix:
-        prefix = prefix1
-        _prev_prefix = prefix1
+    global _prev_prefix
+    prefix = line_prefix()
+    if prefix != _prev_prefix:
+        _prev_prefix = prefix
     else:
-        prefix = prefix2
+        prefix = ' '*(len(prefix)-1)+':'
     print(prefix, *text, file=args.errf)
 
 
 ######### The actual parsing / preprocessing takes place here #########
 
-def parse(inf_name):
+# Expand all macros in the (bracket-escaped) line l. Returns a tuple
+# (expanded line, collected, spliced):
+#  - If an unclosed argument is seen, collected is the line so far, so that the
+#    caller can retry with the next line appended.
+#  - If an \input file is seen, spliced is (parsed_input, prefix, rest of line,
+#    failure) and the expanded line ends just before the \input. The caller
+#    copies the file to the output, and then expands the rest of the line. If
+#    the file fails while it is copied, macro_failed(e, *failure) is called.
+#
+# The line is scanned once, left to right. Text before a match is finished (it
+# has been scanned, and any failed macros are escaped) and is moved to `done`,
+# while the expansion result is put back in front of the cursor so that it is
+# scanned again. This means that a macro can use other macros, by repeated
+# expansion, without rescanning the start of the line for every match.
+# When a macro argument is not closed at the end of the line, the line is
+# returned as collected, and expand_macros is called again with the next line
+# appended. _unclosed is then (collected, position of the macro, scan state), so
+# that the text before the macro is not scanned again, and the argument scan
+# continues where it stopped.
+_unclosed = None
+
+def expand_macros(l, output):
+    global _unclosed
+    re_macro = get_lexer().re_macro
+    done = []
+    done_len = 0
+    resume = None
+    if _unclosed is not None:
+        collected, macro_pos, resume = _unclosed
+        _unclosed = None
+        if l.startswith(collected):
+            done.append(l[:macro_pos])
+            done_len = macro_pos
+            l = l[macro_pos:]
+        else:
+            resume = None
+    while True:
+        # Try to match a macro name (should be successful, but maybe not
+        # if e.g. the line ends with '\\'.
+        match = re_macro.search(l)
+        if not match:
+            break
+
+        start = match.start()
+        len_of_match = match.end()-1-start
+        comm = match.group(1) # the command (macro) name
+        comm_args = []
+        eval_str = ''
+        try:
+            try:
+                comm_args, end = consume_args(l, match.end()-1, resume if start == 0 else None)
+            except unclosed_argument as e:
+                # Retry with next line appended.
+                collected = ''.join(done)+l
+                _unclosed = (collected, done_len+start, e.state)
+                return '', collected, None
+            finally:
+                resume = None
+            l_after_macro = l[end:]
+            l_in_macro = l[start:end]
+            len_of_match = len(l_in_macro)
+            m_prefix = l_in_macro[0]
+            if comm in referenced_files and (args.deps_file or args.build_type):
+                reference_files(comm, comm_args)
+            scan = scan_pattern()
+            if scan is not None and not scan.search(l_in_macro):
+                raise skipped_macro()
+            with eval_scope(m_prefix):
+                global _current_match
+                _current_match = [(output, done, l[:start]),
+                                  l_in_macro,
+                                  l_after_macro]
+                scope = get_scope()
+                comm_obj = get_macro(comm)
+                if _recorders:
+                    record_macro(m_prefix, comm, comm_obj)
+                if comm_obj is None:
+                    comm_obj = scope.get('__missing__')
+                    if _recorders:
+                        record_macro(m_prefix, '__missing__', comm_obj)
+                    if comm_obj is not None:
+                        comm_args = [comm] + comm_args
+                        comm = '__missing__'
+                if comm_obj is None:
+                    raise KeyError(comm)
+                usage_count[comm] += 1
+
+                if args.profile:
+                    t0 = timer()
+                try:
+                    if args.eval_calls:
+                        eval_str = call_str(comm, comm_args)
+                        for arg in comm_args:
+                            assert not '"""' in arg
+                        result = eval(eval_str, get_scope())
+                    else:
+                        # Pass the arguments directly to the macro object. The
+                        # call string is only formatted if it is needed for a message.
+                        eval_str = None
+                        result = call(comm_obj, *comm_args)
+                    if isinstance(result, parsed_input):
+                        if not pending_output and not result.is_empty():
+                            if args.profile:
+                                # The file is expanded later, as it is copied
+                                profile_record(m_prefix+comm, t0, 0, '')
+                            if args.verbose >= 3:
+                                log('>>>', eval_str or call_str(comm, comm_args),
+                                    '==> (contents of %s)'%result.name)
+                            failure = (comm, comm_args, ''.join(done)+l, done_len+start,
+                                       len_of_match, match.group(0), eval_str)
+                            return ''.join(done)+l[:start], '', (result, m_prefix, l_after_macro, failure)
+                        result = str(result)
+                    result = str(result or args.dummy)
+                except StopIteration:
+                    result = escape(l_in_macro[0]) + l_in_macro[1:]
+                finally:
+                    if runs_python(comm_obj):
+                        hidden_changed()
+
+                if pending_output:
+                    result = pop_pending_output() + result
+                if args.profile:
+                    profile_record(m_prefix+comm, t0, len(l_in_macro), result)
+                if args.verbose >= 3:
+                    log((''.join(done)+l).rstrip().replace('\n', r'~'))
+                    log(' '*(done_len+start) + '^'*len(l_in_macro))
+                    log('>>>', eval_str or call_str(comm, comm_args), '==> """%s"""'%result)
+        except skipped_macro:
+            result = escape(l_in_macro[0]) + l_in_macro[1:]
+        except Exception as e:
+            if macro_failed(e, comm, comm_args, ''.join(done)+l, done_len+start,
+                            len_of_match, match.group(0), eval_str):
+                raise
+
+            # Replace the first prefix by an escape sequence, so that we don't try
+            # to expand this (failed) macro again.
+            result = escape(l_in_macro[0]) + l_in_macro[1:]
+
+        if args.verbose >= 1 and l_in_macro in result and not l_in_macro in warned:
+            log('Possible recursion in %s->%s'% (l_in_macro,result))
+            warned.add(l_in_macro)
+
+        # The text before the match is finished. Continue scanning at the start
+        # of the result.
+        done.append(l[:start])
+        done_len += start
+        l = bracket_escape(str(result)) + l_after_macro
+
+    return ''.join(done)+l, '', None
+
+# Log a failed macro call, if verbose enough. Returns True if the error should
+# be raised (see -a).
+def macro_failed(e, comm, comm_args, line, column, len_of_match, match_str, eval_str):
+    if isinstance(e, KeyError) and e.args[0]==comm: severity = 2
+    else:                                           severity = 1
+
+    if args.verbose >= severity:
+        log(line.rstrip().replace('\n', r'~'))
+        log(' '*column + '^'*len_of_match)
+        if eval_str is None:
+            eval_str = call_str(comm, comm_args)
+        for s in match_str, ','.join(map(quote_arg, comm_args)), eval_str, repr(e):
+            if s:
+                log('!!!', s)
+
+    return args.abort >= severity
+
+# Unescape a piece of a line that is split by \input files (see parse). before
+# is the blank text that the previous file ends with, and after is the blank
+# text that the next file starts with; they are None at the ends of the line.
+# The files are not blank between those, so the dummy is removed just as if the
+# whole line was unescaped in one piece. The result includes before and after.
+_file_text = '\0'
+def unescape_piece(l, before=None, after=None):
+    if before is not None:
+        l = _file_text + before + l
+    if after is not None:
+        l = l + after + _file_text
+    l = unescape(l)
+    if before is not None:
+        l = l[len(_file_text):]
+    if after is not None:
+        l = l[:-len(_file_text)]
+    return bracket_unescape(l)
+# Files are read in large blocks. Lines that contain neither a macro prefix nor
+# the block prefix are passed to parse() together, as one plain_lines, so that
+# they are copied to the output in one piece. This is only done when plain_ok()
+# says that parse() has nothing pending (like an unclosed argument, or a %@
+# block that may define new prefixes), and the lines are looked at only when
+# parse() asks for them, so that any new prefixes are seen.
+class plain_lines(str):
+    """Lines (with newlines) without any macro prefix or block prefix."""
+
+def read_blocks(f, plain_ok, size=1<<16):
+    """Yield (line number, line) for the lines of f, and an empty line at the
+    end, like enumerate(f, 1); but yield runs of plain lines together, with
+    the number of the first."""
+    if not hasattr(f, 'read') or args.custom_replacers or args.show_lines:
+        for item in enumerate(itertools.chain(f, ['']), 1):
+            yield item
+        return
+    lno = 1
+    buf = ''
+    pos = 0
+    while True:
+        end = buf.find('\n', pos)
+        if end < 0:
+            # Read until there is a full line
+            block = f.read(size)
+            if block:
+                buf = buf[pos:] + block
+                pos = 0
+                continue
+            if pos < len(buf):
+                yield lno, buf[pos:]
+                lno += 1
+            yield lno, ''
+            return
+        # plain_lines is a str, so with python2 this is not done for unicode
+        # (from --encoding)
+        if isinstance(buf, str) and plain_ok():
+            m = special_regexp().search(buf, pos)
+            # The plain lines end at the line with the match, or the last full line
+            run_end = buf.rfind('\n', pos, m.start() if m else len(buf))+1
+            if run_end > pos:
+                yield lno, plain_lines(buf[pos:run_end])
+                lno += buf.count('\n', pos, run_end)
+                pos = run_end
+                continue
+        yield lno, buf[pos:end+1]
+        lno += 1
+        pos = end+1
+
+_special = (None, None)
+def special_regexp():
+    global _special
+    key = (tuple(args.macro_prefix), args.block_prefix)
+    if _special[0] != key:
+        _special = (key, alternation(dict.fromkeys(list(key[0])+[key[1]])))
+    return _special[1]
+
+def open_text(fname, mode='r'):
+    if args.encoding:
+        return io.open(fname, mode, encoding=args.encoding)
+    return open(fname, mode)
+
+# Parse a file, and yield the output lines as soon as they are finished. The
+# last line is kept in output, since current_match(0) may look at it; earlier
+# lines are dropped so that memory use does not depend on the size of the
+# file (this includes any \input files, which are copied line by line).
+#
+# If a line_reader is given, the lines are read from it instead, and
+# chunk_boundary is yielded after each blank line where no block, argument or
+# continued line is pending (see incremental_parse). If an open file f is given,
+# it is read instead of inf_name (which is used in messages).
+def parse(inf_name, reader=None, f=None):
     output = []
+    nkept = 0       # lines in output that have already been yielded
+    ndropped = 0    # lines removed from the start of output
+    nextra = 0      # pieces of lines in output (see continued_line)
     lines = ''
     collected = ''
     consuming = False
-    if inf_name == '-':
-        inf = sys.stdin
-        inf_name = 'sys.stdin'
+    continued = False
+    block_start = None
+    if reader is not None:
+        inf = source = reader
+    elif f is not None:
+        inf = f
+        source = read_blocks(inf, lambda: not (collected or consuming or lines))
     else:
-        inf = open(inf_name)
+        if inf_name == '-':
+            inf = sys.stdin
+            inf_name = 'sys.stdin'
+            if args.encoding and hasattr(inf, 'buffer'):
+                inf = io.TextIOWrapper(inf.buffer, args.encoding)
+            source = enumerate(itertools.chain(inf, ['']), 1)
+        else:
+            inf = (_loader or open_text)(inf_name)
+            source = read_blocks(inf, lambda: not (collected or consuming or lines))
 
     with inf:
-        for lno,l in enumerate(itertools.chain(inf, [''])):
-            lno += 1
+        for lno,l in source:
+            raw_l = l
+            if not collected:
+                # A new line starts
+                continued = False
+                before = None
+
+            if len(output) > nkept:
+                for out_l in output[nkept:]:
+                    yield out_l
+                ndropped += len(output)-1
+                del output[:-1]
+                nkept = 1
+
+            if isinstance(l, plain_lines):
+                # Copy to the output in one piece, but keep the last line apart
+                # since it may be stripped (see parsed_input)
+                last = l.rfind('\n', 0, -1)+1
+                if last:
+                    output.append(str(l[:last]))
+                output.append(str(l[last:]))
+                continue
 
-            global prefix1, prefix2
-            prefix1 = inf_name+' '+str(lno)+':'
-            prefix2 = ' '*(len(prefix1)-1)+':'
+            global _position
+            _position = (inf_name, lno)
 
             # Handle {%@ ... }%@. We need to save up a full block of code before
             # exec'ing.
             if l.startswith('{'+args.block_prefix):
                 consuming = True
+                block_start = '%s %d' % _position
                 continue
             elif consuming:
                 if l.startswith('}'+args.block_prefix):
                     consuming = False
-                    exec_block(lines)
+                    exec_block(lines, block_start)
                     lines = ''
                     l = pop_pending_output()
                 else:
@@ -463,6 +1025,8 @@ def parse(inf_name):
 
             # Handle %@ lines. We need to save up a full block before exec'ing.
             if l.startswith(args.block_prefix):
+                if not lines:
+                    block_start = '%s %d' % _position
                 l = l[len(args.block_prefix):]
                 new_l = fixup_line(l)
                 lines += new_l
@@ -474,12 +1038,13 @@ def parse(inf_name):
                         output.append('%+'+new_l)
                 continue
             elif lines:
-                exec_block(lines)
+                exec_block(lines, block_start)
                 lines = ''
                 collected = pop_pending_output()
 
             for func in args.custom_replacers:
                 l = func(l)
+                hidden_changed()
 
             if collected:
                 l = collected+l
@@ -487,110 +1052,96 @@ def parse(inf_name):
 
             # Handle in-line macros. We need to save up enough lines to be certain that
             # all arguments are present (i.e., until braces are balanced and 
-            # line continuations (%) are eaten).
-            if any(prefix in l for prefix in args.macro_prefix):
+            # line continuations (%) are eaten). With -P, lines without any
+            # relevant macro are passed through (see scan_pattern), unless
+            # they may be joined with the next line: a '%' may hide the end of
+            # a macro name, and an unclosed argument may hold a relevant macro.
+            scan = scan_pattern()
+            if any(prefix in l for prefix in args.macro_prefix) \
+                    and (scan is None or scan.search(l) or '%' in l
+                         or l.count('{') != l.count('}') or l.count('[') != l.count(']')):
                 l = bracket_escape(l)
                 if '%' in l:
                     collected = l[:l.index('%')]
                     continue
-
-                re_string = r'[%s]([%s]*)[^%s]' \
-                    % (re.escape(''.join(args.macro_prefix)), args.pattern, args.pattern)
-
-                # Run through line repeatedly until no more matches are found. This means
-                # that a macro can use other macros, by repeated expansion.
-                while True:
-                    # Try to match a macro name (should be successful, but maybe not
-                    # if e.g. the line ends with '\\'.
-                    match = re.search(re_string, l)
-                    if not match:
-                        break
-
-                    l_before_macro = l[:match.start()]
-                    len_of_match = match.end()-1-match.start()
-                    l_after_macro = l[match.end()-1:]
-                    comm = match.group(1) # the command (macro) name
-                    comm_args = eval_str = ''
+                continued = False
+
+                l, collected, spliced = expand_macros(l, output)
+                while spliced:
+                    # Copy the \input file to the output, and continue with the
+                    # rest of the line. Everything after the first piece is
+                    # marked as a continuation of this line (see parsed_input).
+                    # Blank text at the edges of the file is held back, and
+                    # unescaped with the text next to it (see unescape_piece).
+                    sub_doc, m_prefix, rest, failure = spliced
+                    blank = ''
                     try:
-                        try:
-                            comm_args,l_after_macro = consume_args(l_after_macro)
-                        except TypeError:
-                            # An unclosed argument was seen. Retry with next line appended.
-                            collected = l
-                            l = ''
-                            break
-                        l_in_macro = l[match.start():len(l)-len(l_after_macro)]
-                        len_of_match = len(l_in_macro)
-                        comm_args = ','.join(comm_args)
-                        m_prefix = l_in_macro[0]
                         with eval_scope(m_prefix):
-                            global _current_match
-                            _current_match = [(output, l_before_macro),
-                                              l_in_macro,
-                                              l_after_macro]
-                            scope = get_scope()
-                            comm_obj = get_macro(comm)
-                            if comm_obj is None:
-                                comm_obj = scope.get('__missing__')
-                                if comm_obj is not None:
-                                    comm_args = 'r"""%s^"""[:-1],'%comm + comm_args
-                                    comm = '__missing__'
-                            if comm_obj is None:
-                                raise KeyError(comm)
-                            usage_count[comm] += 1
-
-                            eval_str = '__builtin__.call(__builtin__.get_macro(r"%s"),%s)'%(comm, comm_args)
-
-                            try:
-                                result = str(eval(eval_str, get_scope()) or args.dummy)
-                            except StopIteration:
-                                result = escape(l_in_macro[0]) + l_in_macro[1:]
-
-                            if pending_output:
-                                result = pop_pending_output() + result
-                            if args.verbose >= 3:
-                                log(l.rstrip().replace('\n', r'~'))
-                                log(' '*match.start() + '^'*len(l_in_macro))
-                                log('>>>', eval_str, '==> """%s"""'%result)
+                            for sub_l in sub_doc:
+                                text = sub_l.rstrip()
+                                if not text:
+                                    blank += sub_l
+                                    continue
+                                pieces = []
+                                if l is not None:
+                                    k = len(sub_l)-len(sub_l.lstrip())
+                                    pieces.append(unescape_piece(l, before, blank+sub_l[:k]))
+                                    l = None
+                                    blank, sub_l, text = '', sub_l[k:], text[k:]
+                                pieces.append(blank+text)
+                                blank = sub_l[len(text):]
+                                for piece in pieces:
+                                    if not piece:
+                                        continue
+                                    if continued:
+                                        piece = continued_line(piece)
+                                        nextra += 1
+                                    continued = True
+                                    for out_l in output[nkept:]:
+                                        yield out_l
+                                    ndropped += len(output)
+                                    output[:] = [piece]
+                                    nkept = 0
                     except Exception as e:
-                        if isinstance(e, KeyError) and e.args[0]==comm: severity = 2
-                        else:                                           severity = 1
-
-                        if args.verbose >= severity:
-                            log(l.rstrip().replace('\n', r'~'))
-                            log(' '*match.start() + '^'*len_of_match)
-                            for s in match.group(0), comm_args, eval_str, repr(e):
-                                if s:
-                                    log('!!!', s)
-
-                        if args.abort >= severity:
+                        _position = (inf_name, lno)
+                        if macro_failed(e, *failure):
                             raise
-
-                        # Replace the first prefix by an escape sequence, so that we don't try
-                        # to expand this (failed) macro again.
-                        result = escape(l_in_macro[0]) + l_in_macro[1:]
-
-                    if args.verbose >= 1 and l_in_macro in result and not l_in_macro in warned:
-                        log('Possible recursion in %s->%s'% (l_in_macro,result))
-                        warned.add(l_in_macro)
-                    l = '%s%s%s' % (l_before_macro, bracket_escape(str(result)), l_after_macro)
+                    _position = (inf_name, lno)
+                    if l is not None:
+                        # Nothing was copied from the file
+                        rest = l + blank + rest
+                        blank = before
+                    before = blank
+                    l, collected, spliced = expand_macros(rest, output)
+                if collected:
+                    continue
 
                 # Replace any escape sequences by the original
-                l = unescape(l)
-                l = bracket_unescape(l)
+                l = unescape_piece(l, before)
 
             if l:
+                if continued:
+                    l = continued_line(l)
+                    nextra += 1
                 output.append(l)
-                if args.show_lines:
-                    if lno==1 or len(output)%6==0:
-                        output.append('%%% ' + prefix1[:-1] + '\n')
+            if (l or continued) and args.show_lines:
+                if lno==1 or (ndropped+len(output)-nextra)%6==0:
+                    output.append('%%%%%% %s %d\n' % _position)
+
+            if reader is not None and not raw_l.strip() \
+                    and not (collected or consuming or lines):
+                for out_l in output[nkept:]:
+                    yield out_l
+                nkept = len(output)
+                yield chunk_boundary
 
+    for out_l in output[nkept:]:
+        yield out_l
 
     if collected:
         raise RuntimeError('Argument not closed, starting at %s:%d\n>>> '
                            % (inf_name,lno-collected.count('\n')-3)
                            +collected.split('\n')[0])
-    return output
 
 ########## Definitions used by the process-latex-commands (-L) mode ###########
 
@@ -615,6 +1166,10 @@ def parse(inf_name):
 
 class latex_new_comm(object):
     r"""A class to hold the state of the \newcommand definition."""
+    # Style files may define thousands of commands, so keep them small
+    __slots__ = ['name', 'finished', 'nargs', 'has_opt_arg', 'opt_arg',
+                 'definition', 'literals', 'slots']
+
     def __init__(self, name, definition=None):
         if definition:
             # Case (1.1)
@@ -628,10 +1183,21 @@ class latex_new_comm(object):
         self.has_opt_arg = False
 
     def set_definition(self, s):
-        s = s.replace('{', '{{').replace('}', '}}')
-        self.definition = re.sub(r'#([0-9])', r'{\1}', s)
+        self.definition = s
+        self.literals = None    # see compile()
+
+    def compile(self):
+        # Split the definition into literal text and argument numbers, so that
+        # format() only has to join the pieces. This is done when the command
+        # is first used, since most commands in a style file are not:
+        #   '$#2^{#1#3}$' --> ['$', '^{', '', '}$'], [2, 1, 3]
+        parts = re.split(r'#([0-9])', self.definition)
+        self.literals = parts[0::2]
+        self.slots = [int(n) for n in parts[1::2]]
 
     def format(self, *args):
+        if self.literals is None:
+            self.compile()
         args = list(args)
         if self.has_opt_arg:
             if len(args) == self.nargs-1:
@@ -645,7 +1211,11 @@ class latex_new_comm(object):
                 if arg != '':
                     raise RuntimeError('%s called with extra arg "%s"' % (self.name, arg))
         args = [None]+args
-        return self.definition.format(*args)
+        ret = [self.literals[0]]
+        for n, literal in zip(self.slots, self.literals[1:]):
+            ret.append(str(args[n]))
+            ret.append(literal)
+        return ''.join(ret)
 
     def __call__(self, *args):
         if self.finished:
@@ -666,6 +1236,24 @@ class latex_new_comm(object):
             self.nargs = int(nargs_or_opt_arg)
         self.set_definition(definition)
         self.finished = True
+        definitions_changed()
+
+    def state(self):
+        """The finished definition, as a list which can be stored (see restore_new_comm)."""
+        if self.literals is None:
+            self.compile()
+        return [self.name, self.nargs, self.has_opt_arg, getattr(self, 'opt_arg', None),
+                self.literals, self.slots]
+
+def restore_new_comm(state):
+    command = latex_new_comm(state[0])
+    (command.nargs, command.has_opt_arg, opt_arg, command.literals, command.slots) = state[1:]
+    command.definition = command.literals[0] + ''.join('#%d%s' % (n, literal) for n, literal
+                                                       in zip(command.slots, command.literals[1:]))
+    if command.has_opt_arg:
+        command.opt_arg = opt_arg
+    command.finished = True
+    return command
 
 def latex_newcommand(name=None, definition=None, redefine=False):
     if name is None:
@@ -673,28 +1261,72 @@ def latex_newcommand(name=None, definition=None, redefine=False):
             log(r'Ignoring \newcommand, not on standard form (no proper argument)')
         ignore()
     # Check if the command is one that is explicitly ignored by user
-    if get_macro(name[1:]) == ignore:
+    old_cmd = get_macro(name[1:])
+    if old_cmd == ignore:
         if args.verbose >= 3:
             log(r'Ignoring \newcommand{%s}'%name)
         ignore()
     command = latex_new_comm(name, definition)
-    old_cmd = get_macro(name[1:])
     if not redefine and old_cmd and args.verbose >= 2 and args.two_pass != 2:
         log('Redefining %s'%name)
     setattr(get_macro(), name[1:], command)
+    definitions_changed()
+    if _recorders:
+        record_definition(_current_match[1][0], name[1:], command)
     if not command.finished:
         return name             # finish definition in new_comm.__call__
 
 def latex_renewcommand(name=None, definition=None):
     return latex_newcommand(name, definition, redefine=True)
 
+class continued_line(str):
+    r"""A piece of output that continues the previous line. When a line contains
+    an \input, parse() yields the file in pieces, but they still count as one
+    line."""
+
+class parsed_input(object):
+    r"""The parsed lines of an \input file. The file is parsed lazily, since
+    parse() copies the lines straight to the output. Converted to a string, it
+    is the whole file on one line. In both cases the last line is stripped."""
+    def __init__(self, name):
+        self.name = name
+        depend_on(name)
+        if _prefetcher:
+            self.lines = _prefetcher.parse(name)
+        elif args.cache_dir and not _loader:
+            self.lines = cached_parse(name)
+        else:
+            self.lines = parse(name)
+        self.first = []
+
+    def __iter__(self):
+        # The last line must be held back until we know it is the last, and
+        # it may be in several pieces.
+        line = []
+        for l in itertools.chain(self.first, self.lines):
+            if line and not isinstance(l, continued_line):
+                for piece in line:
+                    yield piece
+                line = []
+            line.append(l)
+        l = ''.join(line).strip()
+        if l:
+            yield l
+
+    def is_empty(self):
+        # Read until the first text that is not blank
+        for l in self.lines:
+            self.first.append(l)
+            if l.strip():
+                return False
+        return True
+
+    def __str__(self):
+        # parse() has already processed the lines, don't do it again
+        return ''.join(map(escape, self))
+
 def latex_input(name):
-    lines = parse(name+'.tex')
-    if lines:
-        lines[-1] = lines[-1].strip()
-    # parse() has already processed the lines, don't do it again
-    lines = map(escape, lines)
-    return ''.join(lines)
+    return parsed_input(name+'.tex')
 
 
 # _latex holds various info about the document; the document class, 
@@ -725,8 +1357,7 @@ def latex_begin(name, *args):
 def latex_end(name):
     expected_name = _latex['environment'].pop()
     if expected_name != name:
-        global prefix1
-        log(prefix1, 'Expected "\end{%s}", not "%s"'%(expected_name, name))
+        log(line_prefix(), 'Expected "\end{%s}", not "%s"'%(expected_name, name))
     ignore()
 
 def set_latex_parse_mode():
@@ -742,6 +1373,559 @@ def set_latex_parse_mode():
     macros.end           = latex_end
 ############################################################################
 
+############### Cache of expanded \input files (--cache, --incremental) ###############
+
+# While an \input file (or with --incremental, a paragraph of the main file) is
+# expanded, the macros it looks up are recorded with a fingerprint of their
+# definition (or None, if undefined), together with the \newcommands it makes
+# and its effect on the environment stack. The stored expansion is reused as
+# long as the text and all those macros are unchanged, and the definitions are
+# then made again. Text that runs python code, or calls any python macro other
+# than those listed in cache_safe_macros, is not stored since it may have other
+# side effects.
+
+_recorders = []     # one for each text that is being expanded for the cache
+
+class input_recorder(object):
+    def __init__(self):
+        self.deps = {}
+        self.defs = {}
+        self.usage = collections.defaultdict(int)
+        self.files = []
+        self.cacheable = True
+        self.strict = False     # stop at once if not cacheable (see expand_in_worker)
+        self.environment = list(_latex['environment'])
+        _recorders.append(self)
+
+    def stop(self):
+        """Stop recording, and return what is needed to reuse the expansion (or
+        None if it can not be reused)."""
+        _recorders.remove(self)
+        if not self.cacheable:
+            return None
+        defs = []
+        for (prefix, name), command in self.defs.items():
+            if not command.finished:
+                return None
+            defs.append([prefix, name, command.state()])
+        return {'deps': [[prefix, name, fp] for (prefix, name), fp in self.deps.items()],
+                'defs': defs,
+                'usage': self.usage,
+                'files': self.files,
+                'environment': [self.environment, list(_latex['environment'])]}
+
+def macro_fingerprint(obj):
+    """Return a string that identifies the macro definition, None for an undefined
+    macro, or False if the macro can not be cached."""
+    if obj is None:
+        return None
+    if isinstance(obj, str):
+        return 's:'+obj
+    if isinstance(obj, latex_new_comm):
+        if not obj.finished:
+            return False
+        return 'n:'+repr(obj.state())
+    if obj in cache_safe_macros():
+        return 'f:'+obj.__name__
+    return False
+
+def cache_safe_macros():
+    return [latex_input, latex_newcommand, latex_renewcommand, latex_begin, latex_end, ignore]
+
+def record_macro(prefix, name, obj):
+    key = (prefix, name)
+    for r in _recorders:
+        # Skip macros already seen, or defined by the recorded text
+        if key not in r.deps and key not in r.defs:
+            fp = macro_fingerprint(obj)
+            if fp is False:
+                set_uncacheable(r)
+            r.deps[key] = fp
+        if obj is not None:
+            r.usage[name] += 1
+
+def record_definition(prefix, name, command):
+    for r in _recorders:
+        r.defs[(prefix, name)] = command
+
+def record_uncacheable():
+    for r in _recorders:
+        set_uncacheable(r)
+
+def set_uncacheable(r):
+    r.cacheable = False
+    if r.strict:
+        raise stop_expansion()
+
+def recording_valid(recording):
+    if recording['environment'][0] != _latex['environment'] or 'files' not in recording:
+        return False
+    for prefix, name, fp in recording['deps']:
+        if prefix is None:
+            if file_fingerprint(name) != fp:
+                return False
+        elif macro_fingerprint(get_macro(name, prefix)) != fp:
+            return False
+    return True
+
+def replay_recording(recording):
+    """Make the same changes as the recorded expansion did."""
+    for prefix, name, fp in recording['deps']:
+        for r in _recorders:
+            if (prefix, name) not in r.defs:
+                r.deps.setdefault((prefix, name), fp)
+    for prefix, name, state in recording['defs']:
+        command = restore_new_comm(state)
+        setattr(get_macro(None, prefix), name, command)
+        record_definition(prefix, name, command)
+    for name, count in recording['usage'].items():
+        usage_count[name] += count
+        for r in _recorders:
+            r.usage[name] += count
+    for fname in recording['files']:
+        depend_on(fname)
+    _latex['environment'][:] = recording['environment'][1]
+
+def file_fingerprint(fname):
+    digest = hash_file(fname)
+    return digest and binascii.hexlify(digest).decode()
+
+def cache_key(fname, content_fp):
+    import hashlib
+    settings = (args.version, args.macro_prefix, args.pattern, args.escape, args.dummy,
+                args.bracket_words, args.bracket_escape, args.block_prefix,
+                args.format_pattern, args.show_blocks, args.show_lines, args.eval_calls)
+    return hashlib.md5(repr((fname, content_fp, settings)).encode('utf-8')).hexdigest()
+
+def read_lines(f):
+    for l in f:
+        is_continued, l = json.loads(l)
+        yield continued_line(l) if is_continued else l
+
+def write_line(f, l):
+    f.write(json.dumps([isinstance(l, continued_line), l])+'\n')
+
+def cached_parse(fname):
+    """Same as parse(fname), but use the stored expansion from args.cache_dir if
+    it is still valid, and store it otherwise."""
+    content_fp = file_fingerprint(fname)
+    if content_fp is None or args.custom_replacers:
+        for l in parse(fname):
+            yield l
+        return
+    for r in _recorders:
+        r.deps[(None, fname)] = content_fp
+
+    entry = os.path.join(args.cache_dir, cache_key(fname, content_fp))
+    try:
+        with open(entry+'.deps') as f:
+            recording = json.load(f)
+    except (IOError, OSError, ValueError):
+        recording = None
+    if recording and recording_valid(recording):
+        if args.verbose >= 3:
+            log('Using cached expansion of %s' % fname)
+        os.utime(entry+'.deps', None)   # for LRU eviction
+        replay_recording(recording)
+        with open(entry+'.lines') as f:
+            for l in read_lines(f):
+                yield l
+        return
+
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    tmp_name = '%s.tmp%d' % (entry, os.getpid())
+    recorder = input_recorder()
+    finished = False
+    try:
+        with open(tmp_name, 'w') as f:
+            for l in parse(fname):
+                write_line(f, l)
+                yield l
+        finished = True
+    finally:
+        recording = recorder.stop()
+        if finished and recording:
+            os.rename(tmp_name, entry+'.lines')
+            recording['file'] = fname
+            with open(entry+'.deps', 'w') as f:
+                json.dump(recording, f)
+            evict_cache()
+        else:
+            os.remove(tmp_name)
+
+########## Incremental expansion (--incremental) ##########
+
+# The main file is expanded in chunks, which end at blank lines (where nothing
+# is pending). Each chunk is recorded like an \input file for the cache, and
+# stored in a state file together with its expansion. In the next run, a chunk
+# is reused if its text is unchanged and the recording is still valid, i.e. it
+# reads the same macros and environment. %@ blocks and python macros are not
+# recorded, so these chunks are always executed, and the chunks after them are
+# reused only if the macros they read are unchanged. \newcommands are made
+# again when a chunk is reused.
+
+chunk_boundary = object()
+
+class line_reader(object):
+    """The lines of a file, as (line number, line), with an empty line added at the
+    end like in parse(). Lines can be looked at in advance, and skipped."""
+    def __init__(self, f):
+        self.f = f
+        self.lines = itertools.chain(f, [''])
+        self.ahead = collections.deque()
+        self.lno = 0
+        self.consumed = []      # since the start of the chunk
+
+    def __iter__(self):
+        return self
+    def __next__(self):
+        if self.ahead:
+            l = self.ahead.popleft()
+        else:
+            l = next(self.lines)
+        self.lno += 1
+        self.consumed.append(l)
+        return self.lno, l
+    next = __next__
+
+    def peek(self, n):
+        while len(self.ahead) < n:
+            try:
+                self.ahead.append(next(self.lines))
+            except StopIteration:
+                break
+        return list(itertools.islice(self.ahead, 0, n))
+
+    def peek_paragraph(self):
+        """Return the next lines up to and including a blank line."""
+        n = 0
+        while True:
+            if len(self.peek(n+1)) <= n:
+                break
+            n += 1
+            if not self.ahead[n-1].strip():
+                break
+        return list(itertools.islice(self.ahead, 0, n))
+
+    def skip(self, n):
+        for i in range(n):
+            next(self)
+
+    def close(self):
+        if hasattr(self.f, 'close'):
+            self.f.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+def text_fingerprint(lines):
+    import hashlib
+    return hashlib.md5(''.join(lines).encode('utf-8')).hexdigest()
+
+def first_paragraph(lines):
+    for i,l in enumerate(lines):
+        if not l.strip():
+            return lines[:i+1]
+    return lines
+
+class incremental_state(object):
+    """The chunks stored by the previous run, and the state file that is written
+    in this run. The file contains, for each chunk, one line of JSON describing
+    it followed by its expansion (in the format of the cache .lines files)."""
+    def __init__(self, fname):
+        if not os.path.isdir(args.cache_dir):
+            os.makedirs(args.cache_dir)
+        self.name = os.path.join(args.cache_dir,
+                                 cache_key(os.path.abspath(fname), 'incremental')+'.inc')
+        self.tmp_name = '%s.tmp%d' % (self.name, os.getpid())
+        self.fname = fname
+        self.index = collections.defaultdict(list)
+        self.old = None
+        if os.path.exists(self.name):
+            self.old = open(self.name, 'rb')
+            for header in iter(self.old.readline, b''):
+                chunk = json.loads(header.decode('utf-8'))
+                chunk['offset'] = self.old.tell()
+                self.index[chunk['first']].append(chunk)
+                self.old.seek(chunk['size'], os.SEEK_CUR)
+        self.new = open(self.tmp_name, 'wb')
+        self.recorder = None
+        self.finished = False
+
+    def reuse(self, reader):
+        """Yield the stored expansion of the chunks that follow, as long as they
+        are valid, and skip their lines in reader."""
+        while True:
+            paragraph = reader.peek_paragraph()
+            if not paragraph:
+                return
+            for chunk in self.index.get(text_fingerprint(paragraph), []):
+                lines = reader.peek(chunk['nlines'])
+                if len(lines) == chunk['nlines'] and text_fingerprint(lines) == chunk['text'] \
+                        and recording_valid(chunk):
+                    break
+            else:
+                return
+            if args.verbose >= 3:
+                global _position
+                _position = (self.fname, reader.lno+1)
+                log('Reusing %d lines' % chunk['nlines'])
+            reader.skip(chunk['nlines'])
+            replay_recording(chunk)
+            self.old.seek(chunk['offset'])
+            payload = self.old.read(chunk['size'])
+            self.write(chunk, payload)
+            for l in read_lines(payload.decode('utf-8').splitlines(True)):
+                yield l
+
+    def start_chunk(self, reader):
+        reader.consumed = []
+        self.lines = []
+        self.recorder = input_recorder()
+
+    def add(self, l):
+        self.lines.append(l)
+
+    def end_chunk(self, reader):
+        recording = self.recorder.stop()
+        self.recorder = None
+        if recording and reader.consumed:
+            payload = native_io()
+            for l in self.lines:
+                write_line(payload, l)
+            recording['first'] = text_fingerprint(first_paragraph(reader.consumed))
+            recording['text'] = text_fingerprint(reader.consumed)
+            recording['nlines'] = len(reader.consumed)
+            self.write(recording, payload.getvalue().encode('utf-8'))
+
+    def write(self, chunk, payload):
+        chunk = dict((k, v) for k, v in chunk.items() if k != 'offset')
+        chunk['size'] = len(payload)
+        self.new.write(json.dumps(chunk).encode('utf-8')+b'\n')
+        self.new.write(payload)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.old:
+            self.old.close()
+        self.new.close()
+        if self.finished:
+            os.rename(self.tmp_name, self.name)
+        else:
+            os.remove(self.tmp_name)
+
+def incremental_parse(fname):
+    """Same as parse(fname), but reuse the expansion of chunks that are unchanged
+    since the last run."""
+    state = incremental_state(fname)
+    reader = line_reader(open_text(fname))
+    try:
+        for l in state.reuse(reader):
+            yield l
+        state.start_chunk(reader)
+        for l in parse(fname, reader):
+            if l is chunk_boundary:
+                state.end_chunk(reader)
+                for l in state.reuse(reader):
+                    yield l
+                state.start_chunk(reader)
+            else:
+                state.add(l)
+                yield l
+        state.end_chunk(reader)
+        state.finished = True
+    finally:
+        reader.close()
+        state.close()
+
+def evict_cache():
+    """Remove the least recently used entries until the cache is within
+    args.cache_size (in MB)."""
+    entries = collections.defaultdict(lambda: [0, 0])
+    total = 0
+    for fname in os.listdir(args.cache_dir):
+        path = os.path.join(args.cache_dir, fname)
+        key, ext = os.path.splitext(fname)
+        if ext not in ['.deps', '.lines']:
+            continue
+        st = os.stat(path)
+        entries[key][0] = max(entries[key][0], st.st_mtime)
+        entries[key][1] += st.st_size
+        total += st.st_size
+    for mtime, size, key in sorted((e[0], e[1], key) for key, e in entries.items()):
+        if total <= args.cache_size*1024*1024:
+            break
+        for ext in ['.deps', '.lines']:
+            path = os.path.join(args.cache_dir, key+ext)
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+
+########## Parallel expansion of \input files (--jobs) ##########
+
+# The \input files named in the main file are expanded in advance by a pool of
+# forked processes, which start from a copy of the macros as they were when the
+# pool was made. Each file is recorded like for the cache, and the expansion is
+# used if the recording is valid when the file is reached in the main process.
+# Otherwise, the file is expanded again in the main process, and the files that
+# follow are given to the pool again, together with the definitions made in the
+# main process since the pool was made (if no python code has run there, so
+# that they are known); expansions that are no longer wanted are skipped by the
+# workers. The pool is made after the first \input file (typically the
+# preamble), and is kept for the whole run. Workers stop at the first %@ block
+# or python macro, so these are only run once, by the main process. If a worker
+# does not answer within args.build_timeout, the file is expanded in the main
+# process.
+
+def fork_context():
+    """The multiprocessing module (or context) that forks its workers, or None
+    if processes can not be forked here. The workers must be forked, since they
+    start from the state of the parent."""
+    import multiprocessing
+    if not hasattr(os, 'fork'):
+        return None
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            return multiprocessing.get_context('fork')
+        except ValueError:
+            return None
+    return multiprocessing      # python2 forks where it can
+
+class stop_expansion(BaseException):
+    """Raised to stop a worker when the file it expands can not be used. Not an
+    Exception, since expand_macros catches those."""
+
+_prefetcher = None
+_generation = None      # in a worker, the number of the current batch of files
+_replayed = 0           # in a worker, the number of changes made (see expand_in_worker)
+
+class input_prefetcher(object):
+    def __init__(self, fname):
+        self.pending = []       # the \input files that have not been reached
+        re_input = re.compile(re.escape(args.macro_prefix[0])+r'input\s*\{([^{}]*)\}')
+        with open_text(fname) as f:
+            for l in f:
+                l = re.sub(r'(?<!\\)%.*', '', l)
+                self.pending += [name+'.tex' for name in re_input.findall(l)]
+        self.pool = None
+        self.results = collections.defaultdict(collections.deque)
+        self.changes = []       # definitions made in the main process, see main_changes
+        self.recorder = None
+
+    def start(self):
+        """Expand the pending files in the pool, which is made the first time."""
+        global _generation
+        if self.pool is None:
+            if len(self.pending) < 2:
+                return
+            multiprocessing = fork_context()
+            if multiprocessing is None:
+                return
+            _generation = multiprocessing.Value('i', 0)
+            self.pool = multiprocessing.Pool(min(args.jobs, len(self.pending)))
+        else:
+            changes = self.main_changes()
+            if changes is None:
+                # The workers can not catch up; use what they have made
+                self.changes = None
+                return
+            self.changes.append(changes)
+            _generation.value += 1
+        self.recorder = input_recorder()
+        self.hidden_version = _hidden_version
+        self.results = collections.defaultdict(collections.deque)
+        changes = list(self.changes)
+        for name in self.pending:
+            self.results[name].append(self.pool.apply_async(
+                expand_in_worker, (name, _generation.value, changes)))
+
+    def main_changes(self):
+        """Return the definitions made in the main process since the last start,
+        and the environment stack; or None if python code has run."""
+        self.recorder.stop()
+        if _hidden_version != self.hidden_version:
+            return None
+        defs = []
+        for (prefix, name), command in self.recorder.defs.items():
+            if not command.finished:
+                return None
+            defs.append([prefix, name, command.state()])
+        return {'defs': defs, 'environment': list(_latex['environment'])}
+
+    def parse(self, fname):
+        """Same as parse(fname), but use the expansion from the pool if it is valid."""
+        import multiprocessing
+        result = None
+        was_pending = fname in self.pending
+        if was_pending:
+            del self.pending[:self.pending.index(fname)+1]
+            if self.results[fname]:
+                try:
+                    result = self.results[fname].popleft().get(args.build_timeout)
+                except multiprocessing.TimeoutError:
+                    if args.verbose >= 1:
+                        log('No parallel expansion of %s after %ds' % (fname, args.build_timeout))
+        if result is not None and recording_valid(result['recording']):
+            if args.verbose >= 3:
+                log('Using parallel expansion of %s' % fname)
+            args.errf.write(result['log'])
+            replay_recording(result['recording'])
+            for l in result['lines']:
+                yield l
+            return
+
+        lines = cached_parse(fname) if args.cache_dir else parse(fname)
+        for l in lines:
+            yield l
+        if was_pending and self.changes is not None:
+            self.start()
+
+    def close(self):
+        if self.recorder in _recorders:
+            self.recorder.stop()
+        if self.pool:
+            # Let the workers skip what is left, and wait for them to finish
+            _generation.value += 1
+            self.pool.close()
+            waiter = threading.Thread(target=self.pool.join)
+            waiter.daemon = True
+            waiter.start()
+            waiter.join(args.build_timeout)
+            self.pool = None
+        self.results.clear()
+
+def expand_in_worker(fname, generation, changes):
+    """Expand fname in a worker process, after making the changes of the main
+    process that have not been made here. Returns the lines, the log, and the
+    recording; or None if the expansion can not be used, or is no longer
+    wanted."""
+    global _prefetcher, _replayed
+    if generation != _generation.value:
+        return None
+    _prefetcher = None
+    del _recorders[:]
+    for change in changes[_replayed:]:
+        for prefix, name, state in change['defs']:
+            setattr(get_macro(None, prefix), name, restore_new_comm(state))
+        _latex['environment'][:] = change['environment']
+        definitions_changed()
+    _replayed = len(changes)
+    args.errf = native_io()
+    sys.stdout = native_io()
+    recorder = input_recorder()
+    recorder.strict = True
+    try:
+        lines = list(parse(fname))
+    except (Exception, stop_expansion):
+        return None
+    recording = recorder.stop()
+    if recording is None:
+        return None
+    return {'lines': lines, 'log': args.errf.getvalue(), 'recording': recording}
+
 ############### Definitions used by the dependency-printing mode ###############
 def latex_print(n, format, chained_cmd):
     def printer(*args, **kwargs):
@@ -751,10 +1935,12 @@ def latex_print(n, format, chained_cmd):
             print(format%args[n])
         if chained_cmd:
             return chained_cmd(*args, **kwargs)
+    printer.chained_cmd = chained_cmd
     return printer
 
 def set_print_mode(cmd, n=None, format='%s'):
     args.output = False
+    args.print_cmds = args.print_cmds + [cmd]
     scope = get_scope()
     if hasattr(get_macro(), cmd):
         where = get_macro().__dict__
@@ -767,6 +1953,128 @@ def set_print_mode(cmd, n=None, format='%s'):
     old_cmd = where.get(cmd)
     where[cmd] = latex_print(n, format, old_cmd)
 
+# Since only the printed commands matter, the other macros are not expanded if
+# they can not lead to one. A macro is relevant if it is printed, if it is a
+# python macro (which may do anything, such as \input or \newcommand), if it
+# is a \newcommand that is still being defined, or if its definition mentions a
+# relevant macro. Any other macro is left as it is, unless its arguments mention
+# a relevant macro, and lines without relevant macros are not scanned at all.
+# The set of relevant macros is found again when definitions_changed has been
+# called. If there is a __missing__ macro, or the expansion is recorded for the
+# cache or for a worker (see input_recorder), everything is expanded.
+_definitions_version = 0
+_scan = (None, None)    # (state when found, regexp)
+
+class skipped_macro(Exception):
+    """Raised by expand_macros for a macro that is not relevant."""
+
+def definitions_changed():
+    global _definitions_version
+    _definitions_version += 1
+
+def scan_pattern():
+    """Return a regexp matching the relevant macros, or None if all macros
+    must be expanded."""
+    global _scan
+    if not args.print_cmds or args.show_macros or _recorders:
+        return None
+    state = (_definitions_version, tuple(args.macro_prefix), args.pattern)
+    if _scan[0] != state:
+        names = relevant_macros()
+        _scan = (state, names is not None and scan_regexp(names) or None)
+    return _scan[1]
+
+def scan_regexp(names):
+    names = sorted(names, key=len, reverse=True)
+    return re.compile(r'[%s](?:%s)(?![%s])' % (re.escape(''.join(args.macro_prefix)),
+                                                '|'.join(map(re.escape, names)) or '(?!)',
+                                                args.pattern))
+
+def relevant_macros():
+    names = set(args.print_cmds)
+    if args.deps_file or args.build_type:
+        names.update(referenced_files)
+    texts = collections.defaultdict(list)   # name -> definitions
+    seen = set()
+    for s in [main_parser_scope] + list(parser_scopes.values()):
+        if id(s) in seen:
+            continue
+        seen.add(id(s))
+        if s.get('__missing__') is not None:
+            return None
+        for d in s, vars(s['__macros__']):
+            for name, obj in d.items():
+                if isinstance(obj, str):
+                    texts[name].append(obj)
+                elif isinstance(obj, latex_new_comm):
+                    if obj.finished:
+                        texts[name].append(obj.definition)
+                    else:
+                        names.add(name)
+                elif hasattr(obj, '__call__') and obj is not ignore:
+                    names.add(name)
+    while True:
+        regexp = scan_regexp(names)
+        new = [name for name in texts
+               if name not in names and any(regexp.search(t) for t in texts[name])]
+        if not new:
+            return names
+        names.update(new)
+
+############### Definitions used by the dependency file (--deps) ###############
+
+# Commands whose first argument names a file that the output depends on, with
+# the extensions that are tried in order if the name has none. If none of them
+# exists, the first is used, since the file may be made by another rule.
+referenced_files = {
+    'includegraphics': ['.pdf', '.png', '.jpg', '.jpeg', '.eps'],
+    'bibliography':    ['.bib'],
+    'addbibresource':  [''],
+    }
+# The commands above whose argument is a list of files separated by commas.
+# Other names are taken whole, since they may contain commas (graphs.tex).
+file_list_commands = set(['bibliography', 'addbibresource'])
+
+def depend_on(fname):
+    if fname not in args.dependencies:
+        args.dependencies.append(fname)
+    for r in _recorders:
+        if fname not in r.files:
+            r.files.append(fname)
+
+def reference_files(comm, comm_args):
+    if not comm_args:
+        return
+    exts = referenced_files[comm]
+    names = bracket_unescape(unescape(comm_args[0]))
+    for name in names.split(',') if comm in file_list_commands else [names]:
+        name = name.strip()
+        # Skip names that are not known until a macro is expanded
+        if not name or any(prefix in name for prefix in args.macro_prefix):
+            continue
+        if exts and not os.path.splitext(name)[1]:
+            existing = [ext for ext in exts if os.path.exists(name+ext)]
+            name += (existing or exts)[0]
+        depend_on(name)
+
+def make_escape(fname):
+    return re.sub(r'([ #])', r'\\\1', fname).replace('$', '$$')
+
+def write_deps():
+    """Write the makefile rule for --deps."""
+    if args.build_type:
+        target = args.base_name+'.'+args.build_type
+    elif args.outf_name:
+        target = args.outf_name
+    else:
+        target = os.path.splitext(args.deps_file)[0]+'.texp'
+    deps = list(map(make_escape, args.dependencies))
+    with open(args.deps_file, 'w') as f:
+        f.write(' \\\n '.join([make_escape(target)+':'] + deps) + '\n')
+        for fname in args.dependencies:
+            if fname not in args.infiles:
+                f.write('\n%s:\n' % make_escape(fname))
+
 ##########################################################################
 
 ############### Utility functions ###############
@@ -775,7 +2083,9 @@ def ignore(*args):
     if len(args) == 1 and hasattr(args[0], '__call__'):
         func = args[0]
         def f(*args):
-            func(*args)
+            ret = func(*args)
+            if isinstance(ret, parsed_input):
+                str(ret)    # parse it anyway, for any definitions
             ignore()
         return f
     else:
@@ -856,33 +2166,41 @@ def ensure_math(func):
 # Command-line invocation
 ##########################################################################
 
+_included_files = []     # watched by the server, see run_server()
 @builtin
 def include(fname):
-    with open(fname) as f:
+    _included_files.append(os.path.abspath(fname))
+    depend_on(fname)
+    with open_text(fname) as f:
         code = map(fixup_line, f.readlines())
-        exec_block(''.join(code))
+        exec_block(''.join(code), fname)
 
-def parse_args():
+def parse_args(argv=None):
     global args
+    if argv is None:
+        argv = sys.argv
 
-    if len(sys.argv) <= 1:
+    if len(argv) <= 1:
         print(__doc__)
         sys.exit(1)
 
     idx = 1
-    while idx < len(sys.argv):
-        arg = sys.argv[idx]
+    while idx < len(argv):
+        arg = argv[idx]
         if arg in ['-o', '--output']:
             idx += 1
-            args.outf_name = sys.argv[idx]
+            args.outf_name = argv[idx]
             args.base_name, ext = os.path.splitext(args.outf_name)
             if ext in ['.dvi', '.pdf', '.ps']:
                 args.build_type = ext[1:]
                 args.outf_name = args.base_name+'.texp'
-            args.outf = open(args.outf_name, 'w')
+            args.outf = open_text(args.outf_name, 'w')
+        elif arg in ['--timeout']:
+            idx += 1
+            args.build_timeout = float(argv[idx])
         elif arg in ['-v', '--verbose']:
             idx += 1
-            args.verbose = int(sys.argv[idx])
+            args.verbose = int(argv[idx])
         elif arg in ['-M', '--show-macros']:
             args.show_macros = True
         elif arg in ['-B', '--show-blocks']:
@@ -891,21 +2209,27 @@ def parse_args():
             args.show_lines = True
         elif arg in ['-a', '--abort']:
             idx += 1
-            args.abort = int(sys.argv[idx])
+            args.abort = int(argv[idx])
         elif arg in ['-i', '--include']:
             idx += 1
-            include(sys.argv[idx])
+            include(argv[idx])
         elif arg in ['-e', '--expression']:
             idx += 1
-            code = fixup_line(sys.argv[idx])
-            exec_block(code)
+            code = fixup_line(argv[idx])
+            exec_block(code, '-e')
         elif arg in ['-q', '--quiet']:
             args.output = False
+        elif arg in ['--encoding']:
+            idx += 1
+            args.encoding = argv[idx]
+        elif arg in ['--deps']:
+            idx += 1
+            args.deps_file = argv[idx]
         elif arg in ['-L', '--parse-latex-commands']:
             set_latex_parse_mode()
         elif arg in ['-P', '--print-cmd']:
             idx += 1
-            cmd = sys.argv[idx].split(':')
+            cmd = argv[idx].split(':')
             if len(cmd) == 1:
                 set_print_mode(cmd[0])
             elif len(cmd) == 2:
@@ -914,6 +2238,33 @@ def parse_args():
                 set_print_mode(cmd[0], int(cmd[1])-1, cmd[2])
         elif arg in ['-2', '--two-pass']:
             args.two_pass = True
+        elif arg in ['-E', '--eval-calls']:
+            args.eval_calls = True
+        elif arg in ['--cache']:
+            idx += 1
+            args.cache_dir = argv[idx]
+        elif arg in ['--cache-size']:
+            idx += 1
+            args.cache_size = float(argv[idx])
+        elif arg in ['--incremental']:
+            args.incremental = True
+            if not args.cache_dir:
+                args.cache_dir = '.latex.py-cache'
+        elif arg in ['--batch']:
+            idx += 1
+            args.batch = argv[idx]
+        elif arg in ['--server']:
+            idx += 1
+            args.server = argv[idx]
+        elif arg in ['--profile']:
+            args.profile = True
+        elif arg in ['--profile-json']:
+            idx += 1
+            args.profile = True
+            args.profile_json = argv[idx]
+        elif arg in ['-j', '--jobs']:
+            idx += 1
+            args.jobs = int(argv[idx])
         elif arg in ['-h', '--help']:
             print(__doc__)
             sys.exit(0)
@@ -924,7 +2275,20 @@ def parse_args():
             break
         idx += 1
 
-    args.infiles = sys.argv[idx:]
+    args.infiles = argv[idx:]
+
+def show_profile():
+    rows = sorted(profile.items(), key=lambda item: -item[1][1])
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            json.dump(dict((key, {'calls': calls, 'time': t, 'rescans': rescans, 'growth': growth})
+                           for key, (calls, t, rescans, growth) in rows), f, indent=1)
+        return
+    print('%8s %10s %10s %8s %10s  %s' % ('calls', 'total[ms]', 'call[us]', 'rescans',
+                                         'growth', 'macro / block'), file=args.errf)
+    for key, (calls, t, rescans, growth) in rows:
+        print('%8d %10.2f %10.1f %8d %10d  %s' % (calls, t*1e3, t*1e6/calls, rescans, growth, key),
+              file=args.errf)
 
 def show_macros():
     builtin_macros = []
@@ -968,11 +2332,17 @@ def closing(f):
     try:
         yield f
     finally:
-        if not f.isatty(): # <-- here
+        if f is sys.stdout:
+            f.flush()
+        elif not f.isatty(): # <-- here
             f.close()
 
+_in_path = {}
 def in_path(cmd):
-    return any(os.path.exists(os.path.join(d, cmd)) for d in os.environ['PATH'].split(os.pathsep))
+    if cmd not in _in_path:
+        _in_path[cmd] = any(os.path.exists(os.path.join(d, cmd))
+                            for d in os.environ['PATH'].split(os.pathsep))
+    return _in_path[cmd]
 
 def fgrep_file(string, fname):
     with open(fname) as f:
@@ -990,80 +2360,707 @@ def hash_file(fname):
             m.update(l)
     return m.digest()
 
-def system(cmd, i):
-    if args.verbose > 0:
-        print('[%d]'%i, cmd, file=args.errf)
-    return os.system(cmd)
+# The build commands are run with no input, so that they fail instead of waiting
+# for an answer, and are killed if they take longer than args.build_timeout.
+class command_timeout(Exception):
+    pass
 
-def build_bibtex(aux_fname):
-    aux_files = []
+def run_command(cmd, i, output=False):
+    """Run cmd (a list), and return the exit status; or if output is set, the
+    exit status and the output, which the caller prints together with the
+    command. Raises command_timeout if it takes too long."""
+    if args.verbose > 0 and not output:
+        print('[%d]'%i, ' '.join(cmd), file=args.errf)
+    t0 = timer()
+    with open(os.devnull, 'r+') as devnull:
+        p = subprocess.Popen(cmd, stdin=devnull, stderr=subprocess.STDOUT,
+                             stdout=subprocess.PIPE if output else devnull)
+    killed = []
+    def kill():
+        killed.append(True)
+        p.kill()
+    killer = threading.Timer(args.build_timeout, kill)
+    killer.start()
+    try:
+        out = p.communicate()[0]
+    finally:
+        killer.cancel()
+    if killed:
+        raise command_timeout('%s killed after %ds' % (cmd[0], args.build_timeout))
+    if args.verbose > 0 and not output:
+        print('[%d] %s: %.2fs' % (i, cmd[0], timer()-t0), file=args.errf)
+    if output:
+        return p.returncode, out.decode('utf-8', 'replace')
+    return p.returncode
+
+def log_error(log_fname, context=15):
+    """Return the first error (a line starting with '!') in the latex log, and the
+    lines after it. The rest of the log is not read."""
+    lines = []
+    with open(log_fname, 'rb') as f:
+        for l in f:
+            if lines or l.startswith(b'!'):
+                lines.append(l.decode('utf-8', 'replace'))
+                if len(lines) > context:
+                    break
+    return ''.join(lines)
+
+def bibtex_aux_files(aux_fname):
+    """The .aux files that bibtex should be run on."""
+    if not os.path.exists(aux_fname):
+        return []
     if fgrep_file(r'\gdef\bu@bibdata{', aux_fname):
         import glob
-        aux_files = glob.glob('bu[0-9]*.aux')
+        return sorted(glob.glob('bu[0-9]*.aux'))
     elif fgrep_file(r'\bibdata{', aux_fname):
-        aux_files = [aux_fname]
-    if not aux_files:
+        return [aux_fname]
+    return []
+
+def bibtex_commands(aux_f):
+    """Yield the lines of aux_f that bibtex reads (the citations, styles and
+    databases), each with the local .bib and .bst files that it names."""
+    with open(aux_f, 'rb') as f:
+        for l in f:
+            for cmd, ext in (b'\\citation{', None), (b'\\bibdata{', '.bib'), (b'\\bibstyle{', '.bst'):
+                if l.startswith(cmd):
+                    names = l[len(cmd):].rstrip().rstrip(b'}').decode('utf-8', 'replace')
+                    yield l, [name+ext for name in names.split(',')
+                              if ext and os.path.exists(name+ext)]
+
+def bibtex_fingerprint(aux_f):
+    """A fingerprint of what bibtex reads: the citations, styles and databases
+    named in aux_f, and the local .bib and .bst files."""
+    import hashlib
+    m = hashlib.md5()
+    for l, fnames in bibtex_commands(aux_f):
+        m.update(l)
+        for fname in fnames:
+            m.update(hash_file(fname))
+    return binascii.hexlify(m.digest()).decode()
+
+def run_bibtex(aux_f):
+    """Run bibtex on aux_f, and return the command, exit status, output, time
+    taken and .bbl fingerprint before the run."""
+    bbl_hash = hash_file('%s.bbl' % aux_f[:-4])
+    if in_path('bibtex8'):
+        cmd = ['bibtex8', '-c', 'ascii', '-W', aux_f[:-4]]
+    else:
+        cmd = ['bibtex', aux_f[:-4]]
+    t0 = timer()
+    status, out = run_command(cmd, 1, output=True)
+    return cmd, status, out, timer()-t0, bbl_hash
+
+# Bibtex is only run on the .aux files whose citations or databases have changed
+# since it was last run (according to bibtex_state, which is updated), or whose
+# .bbl file is missing. With bibunits there may be many of these, so they are
+# run in parallel; the output is printed in order. Returns True if any .bbl file
+# has changed.
+def build_bibtex(aux_files, bibtex_state):
+    from multiprocessing.pool import ThreadPool
+    import multiprocessing
+    fps = dict((f, bibtex_fingerprint(f)) for f in aux_files)
+    todo = [f for f in aux_files
+            if fps[f] != bibtex_state.get(f) or not os.path.exists('%s.bbl' % f[:-4])]
+    if len(todo) < len(aux_files) and args.verbose > 0:
+        print('=== No change in the citations of %s'
+              % ', '.join(f for f in aux_files if f not in todo))
+    if not todo:
         return False
 
     redo = False
-    for  aux_f in aux_files:
-        bbl_fname = '%s.bbl' % aux_f[:-4]
-        bbl_hash = hash_file(bbl_fname)
-        if in_path('bibtex8'):
-            system('bibtex8 -c ascii -W %s' % aux_f[:-4], 1)
-        else:
-            system('bibtex %s' % aux_f[:-4], 1)
-        if bbl_hash != hash_file(bbl_fname):
-            redo = True
-            print('=== %s changed' % bbl_fname)
-        else:
-            print('=== No change in %s' % bbl_fname)
+    pool = ThreadPool(min(len(todo), max(args.jobs, multiprocessing.cpu_count())))
+    try:
+        for aux_f, (cmd, status, out, t, bbl_hash) in zip(todo, pool.imap(run_bibtex, todo)):
+            if args.verbose > 0:
+                print('[1] %s: %.2fs' % (' '.join(cmd), t), file=args.errf)
+            sys.stdout.write(out)
+            if status < 2:      # 1 is warnings, 2 is errors
+                bibtex_state[aux_f] = fps[aux_f]
+            bbl_fname = '%s.bbl' % aux_f[:-4]
+            if bbl_hash != hash_file(bbl_fname):
+                redo = True
+                print('=== %s changed' % bbl_fname)
+            else:
+                print('=== No change in %s' % bbl_fname)
+    finally:
+        pool.close()
     return redo
-    
+
+# The state of the last finished build is stored in <base>.latex.py-build: the
+# fingerprints of the files that latex read (the .texp file, the files named by
+# \includegraphics etc, and the local files listed in the .fls file) and the
+# .bib and .bst files that bibtex read, of the auxiliary files and the output
+# file, and of what bibtex read for each .aux file. Latex is not run if none of
+# these have changed. Otherwise it is run again as long as any of the
+# auxiliary files (which are read by the next run) change, and bibtex is run
+# when the citations or databases have changed.
+aux_extensions = ['.aux', '.toc', '.lof', '.lot', '.out', '.nav', '.snm']
+
+def fingerprints(names):
+    return dict((name, file_fingerprint(name)) for name in names)
+
+def build_inputs():
+    """The files read by latex, except the auxiliary files (see build_latex)."""
+    names = [args.outf_name] + [f for f in args.dependencies if f not in args.infiles]
+    ignored = set(args.base_name+ext for ext in aux_extensions+['.fls', '.log'])
+    try:
+        with open(args.base_name+'.fls') as f:
+            for l in f:
+                if l.startswith('INPUT '):
+                    name = os.path.normpath(l[6:].strip())
+                    if not os.path.isabs(name) and not name.startswith('..'):
+                        names.append(name)
+    except (IOError, OSError):
+        pass
+    # bibtex is not recorded in the .fls file
+    for aux_f in bibtex_aux_files(args.base_name+'.aux'):
+        for l, fnames in bibtex_commands(aux_f):
+            names.extend(fnames)
+    return sorted(set(names) - ignored)
 
 def build_latex():
-    """Run *latex/bibtex until .aux file no longer changes (max 5 times)."""
+    """Run *latex/bibtex until the auxiliary files no longer change (max 5
+    times), unless nothing has changed since the last build."""
     global args
     latex = args.build_type+'latex' if args.build_type!='dvi' else 'latex'
     if in_path(latex):
+        target = '%s.%s' % (args.base_name, args.build_type)
+        state_fname = '%s.latex.py-build' % args.base_name
+        try:
+            with open(state_fname) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+        if state and file_fingerprint(target) == state['output'] \
+                and all(fingerprints(state[k]) == state[k] for k in ['inputs', 'aux']) \
+                and all(os.path.exists(aux_f) and bibtex_fingerprint(aux_f) == fp
+                        for aux_f, fp in state.get('bibtex', {}).items()):
+            print('=== No change since the last build of %s' % target)
+            return
+        if os.path.exists(state_fname):
+            os.remove(state_fname)  # until this build is finished
+
         aux_fname = '%s.aux' % args.base_name
-        aux_hash = hash_file(aux_fname)
-        for i in range(5):
-            if system('%s -interaction=batchmode %s >/dev/null' % (latex, args.outf_name), i+1):
-                print('=== Error in build:')
-                system("grep -A15 -m1 '^!' %s.log" % args.base_name, i+1)
-                sys.exit(1)
-            new_aux_hash = hash_file(aux_fname)
-            redo_because_of_bibtex = (i==0 and build_bibtex(aux_fname))
-            if new_aux_hash == aux_hash and not redo_because_of_bibtex:
-                print('=== No change in %s; build finished' % aux_fname)
-                break
-            else:
-                aux_hash = new_aux_hash
+        aux_files = [args.base_name+ext for ext in aux_extensions]
+        aux_state = fingerprints(aux_files)
+        bibtex_state = state.get('bibtex', {})
+        try:
+            for i in range(5):
+                status = run_command([latex, '-interaction=batchmode', '-recorder',
+                                      args.outf_name], i+1)
+                if status:
+                    print('=== Error in build:')
+                    if os.path.exists('%s.log' % args.base_name):
+                        sys.stdout.write(log_error('%s.log' % args.base_name))
+                    sys.exit(1)
+                new_aux_state = fingerprints(aux_files)
+                changed = [f for f in aux_files if new_aux_state[f] != aux_state[f]]
+                aux_state = new_aux_state
+
+                redo_because_of_bibtex = build_bibtex(bibtex_aux_files(aux_fname), bibtex_state)
+
+                if not changed and not redo_because_of_bibtex:
+                    print('=== No change in %s; build finished' % aux_fname)
+                    with open(state_fname, 'w') as f:
+                        json.dump({'output': file_fingerprint(target),
+                                   'inputs': fingerprints(build_inputs()),
+                                   'aux': aux_state,
+                                   'bibtex': bibtex_state}, f, indent=1)
+                    break
+                if changed:
+                    print('=== Changed: %s' % ', '.join(changed))
+        except command_timeout as e:
+            print('=== Error in build: %s' % e)
+            sys.exit(1)
     else:
         print('*** Error: "%s" not found in PATH, skipping build.' % latex, file=args.errf)
         print('*** Use "-o %s" instead, and run latex on that one yourself.' % args.outf_name,
               file=args.errf)
 
+########## Batch mode (--batch) ##########
+
+class state_snapshot(object):
+    """A copy of the parser state (the scopes and their macros, args, and the
+    other globals that expansion changes), which can be restored later. Lists,
+    dicts and sets in the scopes, and those in them, are restored in place,
+    since they may also be referred to elsewhere (like _latex and usage_count).
+    Other objects, like modules and files, are not copied."""
+    def __init__(self):
+        self.main_scope = main_parser_scope
+        self.parser_scopes = dict(parser_scopes)
+        self.scopes = []
+        self.containers = {}
+        for s in [main_parser_scope] + list(parser_scopes.values()):
+            if any(s is saved for saved, _, _ in self.scopes):
+                continue
+            macros = s['__macros__']
+            self.scopes.append((s, dict(s), (macros, dict(vars(macros)))))
+            self.save_containers(list(s.values()) + list(vars(macros).values()))
+        self.args = dict((k, v) for k, v in vars(args).items()
+                         if not k.startswith('__') and k not in ['outf', 'errf'])
+        self.save_containers(self.args.values())
+        self.warned = set(warned)
+
+    def save_containers(self, values):
+        # Keep a shallow copy of each list, dict and set, found by following
+        # the containers (shared ones are saved once)
+        stack = list(values)
+        while stack:
+            val = stack.pop()
+            if not isinstance(val, (list, dict, set)) or id(val) in self.containers:
+                continue
+            if isinstance(val, dict):
+                self.containers[id(val)] = (val, dict(val))
+                stack.extend(val.values())
+            else:
+                self.containers[id(val)] = (val, list(val))
+                stack.extend(val)
+
+    def restore(self):
+        global main_parser_scope
+        main_parser_scope = self.main_scope
+        parser_scopes.clear()
+        parser_scopes.update(self.parser_scopes)
+        for s, contents, (macros, attrs) in self.scopes:
+            s.clear()
+            s.update(contents)
+            vars(macros).clear()
+            vars(macros).update(attrs)
+        for obj, saved in self.containers.values():
+            if isinstance(obj, list):
+                obj[:] = saved
+            else:
+                obj.clear()
+                obj.update(saved)
+        for k, v in self.args.items():
+            setattr(args, k, v)
+        args.outf = sys.stdout
+        warned.clear()
+        warned.update(self.warned)
+        profile.clear()
+        hidden_changed()
+        reset_expansion()
+
+def reset_expansion():
+    """Drop what an expansion may leave behind when it stops early: pending
+    output, an unclosed argument, recorders and the message position."""
+    global pending_output, _prev_prefix, _unclosed, _position
+    pending_output = []
+    _prev_prefix = None
+    _unclosed = None
+    _position = ('', 0)
+    del _recorders[:]
+
+def run():
+    """Expand the input files given by args."""
+    global _prefetcher
+    if args.two_pass:
+        for inf in args.infiles:
+            for l in parse(inf):
+                pass
+        args.two_pass = 2
+    with closing(args.outf):
+        for inf in args.infiles:
+            if inf != '-':
+                depend_on(inf)
+            if args.jobs > 1 and inf != '-' and not args.custom_replacers:
+                _prefetcher = input_prefetcher(inf)
+            if args.incremental and inf != '-' and not (args.two_pass or args.show_lines):
+                lines = incremental_parse(inf)
+            else:
+                lines = parse(inf)
+            try:
+                if args.output:
+                    args.outf.writelines(lines)
+                else:
+                    for l in lines:
+                        pass
+            finally:
+                if _prefetcher:
+                    _prefetcher.close()
+                    _prefetcher = None
+
+    if args.deps_file:
+        write_deps()
+    if args.show_macros:
+        show_macros()
+    if args.profile:
+        show_profile()
+    if args.verbose >= 3:
+        print('Format cache: %d hits, %d misses, %d entries' % format_cache_info(),
+              file=args.errf)
+    if args.build_type:
+        build_latex()
+
+def run_batch(fname):
+    """Run each line of fname as a separate job, with the options and input
+    files of a latex.py command line. Each job starts from the state left by
+    the options before --batch, and by parsing the input files given there.
+    A job that fails is reported, and the other jobs are still run; the exit
+    status is then 1."""
+    import shlex
+    import traceback
+    for inf in args.infiles:
+        for l in parse(inf):
+            pass
+    snapshot = state_snapshot()
+    with open(fname) as f:
+        jobs = [l.strip() for l in f]
+    failed = []
+    for job in jobs:
+        if not job or job.startswith('#'):
+            continue
+        snapshot.restore()
+        if args.verbose >= 3:
+            print('=== Batch job: %s' % job, file=args.errf)
+        try:
+            parse_args(['latex.py'] + shlex.split(job))
+            run()
+        except SystemExit as e:
+            if e.code:
+                failed.append(job)
+        except Exception:
+            print('*** Error in batch job: %s' % job, file=args.errf)
+            traceback.print_exc(file=args.errf)
+            failed.append(job)
+    snapshot.restore()
+    if failed:
+        print('*** %d of the batch jobs failed:' % len(failed), file=args.errf)
+        for job in failed:
+            print('***     %s' % job, file=args.errf)
+        sys.exit(1)
+
+########## Library use (Parser) ##########
+
+# The parser state is kept in module globals, since that is what the macros and
+# the %@ code see. A Parser has a state of its own, which is swapped into the
+# globals when it is used (see state_snapshot), so that several parsers can be
+# used in one process. The state stays there until another parser is used, so
+# that repeated calls to one parser do not copy anything. The calls are
+# serialized by _parser_lock.
+_parser_lock = threading.RLock()
+_initial_state = None   # the state before any parser was made
+_active_parser = None   # the Parser whose state is in the globals
+_outside_state = None   # the state (and loader) saved when a parser was first used
+
+def switch_parser(parser):
+    """Make the state of parser the global state, or for None, the state
+    outside of any parser. The state of the parser that was active is saved."""
+    global _active_parser, _outside_state, _loader
+    if parser is _active_parser:
+        return
+    if _active_parser is None:
+        _outside_state = state_snapshot(), _loader
+    else:
+        _active_parser.state = state_snapshot()
+    if parser is None:
+        _outside_state[0].restore()
+        _loader = _outside_state[1]
+    else:
+        parser.state.restore()
+        _loader = parser.loader
+    _active_parser = parser
+
+class Parser(object):
+    r"""A parser with a state of its own, set up by the given command-line
+    options (without input files). The files (given to parse_file, or read
+    by \input) are opened by the loader, see dict_loader. Example:
+
+        p = latex.Parser(['-L', '-i', 'macros.py'])
+        p.define('R', r'\mathbb{R}', '\\')
+        text = p.parse_file('paper.tex')
+    """
+    def __init__(self, options=(), loader=None):
+        global _initial_state
+        self.loader = loader
+        with _parser_lock:
+            switch_parser(None)
+            saved = state_snapshot()
+            if _initial_state is None:
+                _initial_state = saved
+            _initial_state.restore()
+            try:
+                if options:
+                    parse_args(['latex.py'] + list(options))
+                    if args.infiles:
+                        raise ValueError('Not an option: %s' % args.infiles[0])
+                self.state = state_snapshot()
+            finally:
+                saved.restore()
+
+    @contextlib.contextmanager
+    def active(self):
+        """Make this parser's state the global state, and hold the lock while
+        in the block."""
+        with _parser_lock:
+            switch_parser(self)
+            reset_expansion()
+            yield self
+
+    def parse_file(self, fname):
+        """Return the expansion of the file fname."""
+        with self.active():
+            return ''.join(parse(fname))
+
+    def parse_string(self, text, name='<string>'):
+        """Return the expansion of text (a string, or lines ending with
+        newlines). The name is used in messages."""
+        with self.active():
+            return expand_string(text, name)
+
+    def include(self, fname):
+        """Execute a python file, like -i."""
+        with self.active():
+            include(fname)
+
+    def define(self, name, definition, prefix=None):
+        """Define a macro for the given prefix (by default the first): a
+        function, or a format string like those assigned in %@ blocks."""
+        with self.active():
+            setattr(get_macro(None, prefix), name, definition)
+
+    def pool(self, processes=None):
+        """Return a parser_pool with the current macros of this parser."""
+        with _parser_lock:
+            if _active_parser is self:
+                self.state = state_snapshot()
+            return parser_pool(self.state, processes, self.loader)
+
+# Since the parser state is global, and the expansion is limited by the GIL
+# anyway, many texts are not expanded in threads but in a pool of forked
+# processes. The state of a Parser is frozen when the pool is made, and each
+# text is expanded from that state, so that texts do not see each other's
+# definitions, environments or pending output. Most texts leave the state as
+# it was, so a worker only restores it after a text that may have changed it
+# (see state_version). The pool may be used from several threads.
+_frozen_state = None    # in a worker, the state that each text starts from
+_frozen_version = None  # in a worker, state_version() when it was restored
+
+class parser_pool(object):
+    """Expand texts in <processes> worker processes [number of CPUs]. Where
+    processes can not be forked, the texts are expanded one at a time in this
+    process instead, each from the frozen state."""
+    def __init__(self, state, processes=None, loader=None):
+        global _frozen_state, _loader
+        self.pool = None
+        multiprocessing = fork_context()
+        if multiprocessing is None:
+            self.state = state
+            self.parser = Parser(loader=loader)
+            return
+        with _parser_lock:
+            saved_loader = _loader
+            _frozen_state, _loader = state, loader
+            try:
+                self.pool = multiprocessing.Pool(processes)
+            finally:
+                _frozen_state, _loader = None, saved_loader
+
+    def expand_here(self, text, name):
+        with self.parser.active():
+            self.state.restore()
+            return expand_string(text, name)
+
+    def parse_string(self, text, name='<string>'):
+        """Return the expansion of text. Messages are written to args.errf."""
+        if self.pool is None:
+            return self.expand_here(text, name)
+        out, messages = self.pool.apply(expand_in_pool_worker, (text, name))
+        args.errf.write(messages)
+        return out
+
+    def map(self, texts):
+        """Return the expansions of the texts, in order."""
+        if self.pool is None:
+            return [self.expand_here(text, '<string>') for text in texts]
+        results = self.pool.map(expand_in_pool_worker, [(text, '<string>') for text in texts])
+        for out, messages in results:
+            args.errf.write(messages)
+        return [out for out, messages in results]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+# Changes when python code has run or macros were defined (see hidden_changed),
+# when a recursion warning was given, and when an environment was left open.
+def state_version():
+    return (_definitions_version, len(warned), tuple(_latex['environment']))
+
+def expand_in_pool_worker(text, name='<string>'):
+    global _frozen_version, main_parser_scope
+    if isinstance(text, tuple):
+        text, name = text   # from parser_pool.map
+    if state_version() != _frozen_version:
+        _frozen_state.restore()
+        _frozen_version = state_version()
+    else:
+        main_parser_scope = _frozen_state.main_scope
+        reset_expansion()
+    args.errf = native_io()
+    return expand_string(text, name), args.errf.getvalue()
+
+def expand_string(text, name):
+    if not isinstance(text, str):
+        text = ''.join(text)
+    return ''.join(parse(name, f=native_io(text)))
+
+# A loader opens the files that are parsed, instead of open(). It is called with
+# the file name, and returns a file object (or any iterable of lines that can be
+# used in a with statement), or raises IOError.
+_loader = None
+
+def dict_loader(files):
+    """A loader for files held in memory, as a dict of file name -> contents."""
+    def load(fname):
+        if fname not in files:
+            raise IOError(2, 'No such file', fname)
+        return native_io(files[fname])
+    return load
+
+def zip_loader(zip_fname, encoding='utf-8'):
+    """A loader for files in a zip archive."""
+    import zipfile
+    archive = zipfile.ZipFile(zip_fname)
+    def load(fname):
+        try:
+            f = archive.open(fname)
+        except KeyError:
+            raise IOError(2, 'No such file in %s' % zip_fname, fname)
+        return io.TextIOWrapper(f, encoding)
+    return load
+
+########## Server mode (--server, --client) ##########
+
+# The client sends one line of JSON with the command line, the working directory
+# and (if the input is '-') standard input. The server runs it like a batch job,
+# with stdout and stderr captured, and answers with a JSON object that holds
+# these and the exit status.
+
+def files_state(names):
+    return [(name, os.path.exists(name) and os.path.getmtime(name)) for name in names]
+
+def run_server(path):
+    import socket
+    for inf in args.infiles:
+        for l in parse(inf):
+            pass
+    snapshot = state_snapshot()
+    watched_files = _included_files + [os.path.abspath(f) for f in args.infiles if f != '-']
+    watched = files_state(watched_files)
+    start_dir = os.getcwd()
+
+    # After a restart, the listening socket and the waiting client are inherited
+    pending = []
+    fds = os.environ.pop('LATEX_PY_SERVER_FDS', None)
+    if fds:
+        listen_fd, conn_fd = map(int, fds.split(','))
+        server = socket.fromfd(listen_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        pending.append(socket.fromfd(conn_fd, socket.AF_UNIX, socket.SOCK_STREAM))
+        os.close(listen_fd)
+        os.close(conn_fd)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(5)
+    if args.verbose >= 3:
+        print('=== Server listening on %s' % path, file=args.errf)
+
+    try:
+        while True:
+            conn = pending.pop() if pending else server.accept()[0]
+            if files_state(watched_files) != watched:
+                if args.verbose >= 3:
+                    print('=== Input changed, restarting server', file=args.errf)
+                for s in server, conn:
+                    if hasattr(os, 'set_inheritable'):
+                        os.set_inheritable(s.fileno(), True)
+                os.environ['LATEX_PY_SERVER_FDS'] = '%d,%d' % (server.fileno(), conn.fileno())
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            try:
+                serve_request(conn, snapshot)
+            except Exception as e:
+                # A broken request or a client that went away
+                print('*** Error in server request: %s' % e, file=args.errf)
+            finally:
+                conn.close()
+                os.chdir(start_dir)
+                snapshot.restore()
+    finally:
+        server.close()
+
+def serve_request(conn, snapshot):
+    import traceback
+    request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+    errf = args.errf
+    stdout, stdin = sys.stdout, sys.stdin
+    text = request['stdin'] or ''
+    if not isinstance(text, str):
+        text = text.encode('utf-8')     # python2, where json gives unicode
+    sys.stdout = native_io()
+    sys.stdin = native_io(text)
+    snapshot.restore()
+    args.errf = native_io()
+    status = 0
+    try:
+        os.chdir(request['cwd'])
+        parse_args(['latex.py'] + request['argv'])
+        run()
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        traceback.print_exc(file=args.errf)
+        status = 1
+    finally:
+        response = {'stdout': sys.stdout.getvalue(), 'stderr': args.errf.getvalue(),
+                    'status': status}
+        sys.stdout, sys.stdin = stdout, stdin
+        args.errf = errf
+    conn.sendall(json.dumps(response).encode('utf-8'))
+
+def run_client(path, argv):
+    """Run the command line argv in the server at path. Returns the exit status,
+    or None if there is no server."""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        return None
+    request = {'argv': argv, 'cwd': os.getcwd(),
+               'stdin': sys.stdin.read() if '-' in argv else None}
+    with contextlib.closing(client):
+        client.sendall(json.dumps(request).encode('utf-8')+b'\n')
+        response = json.loads(client.makefile('rb').read().decode('utf-8'))
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
 def main():
     global args
+    if len(sys.argv) > 2 and sys.argv[1] == '--client':
+        status = run_client(sys.argv[2], sys.argv[3:])
+        if status is None:
+            # Running it here would miss the options given to the server
+            print('*** Error: no latex.py server at %s' % sys.argv[2], file=sys.stderr)
+            status = 1
+        sys.exit(status)
     parse_args()
 
     with closing(args.errf):
-        if args.two_pass:
-            for inf in args.infiles:
-                parse(inf)
-            args.two_pass = 2
-        with closing(args.outf):
-            for inf in args.infiles:
-                lines = parse(inf)
-                if args.output:
-                    args.outf.writelines(lines)
-
-        if args.show_macros:
-            show_macros()
-        if args.build_type:
-            build_latex()
+        if args.server:
+            run_server(args.server)
+        elif args.batch:
+            run_batch(args.batch)
+        else:
+            run()
 
 if __name__ == '__main__':
     v = eval('%s.%s' % sys.version_info[:2])